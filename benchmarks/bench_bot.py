@@ -0,0 +1,18 @@
+import bot
+import e6handler
+from common import load_json_fixture
+
+MESSAGE = ("omg look https://www.furaffinity.net/view/45678901/ and https://e621.net/posts/3141592?q=fox also "
+           "https://static1.e621.net/data/d4/1d/d41d8cd98f00b204e9800998ecf8427e.png and the same "
+           "https://e621.net/posts/3141592 again, plus a lot of ordinary chatter that contains no links at all " * 2)
+CHATTER = "just regular channel chatter without any links in it, which is what most lines look like :3"
+
+
+def benchmarks():
+    post = e6handler.compact_post(load_json_fixture('e621_post.json')['post'])
+
+    yield 'extract_links', lambda: bot.extract_links(MESSAGE)
+    yield 'extract_links_no_match', lambda: bot.extract_links(CHATTER)
+    yield 'e621_create_poststr', lambda: bot.FABot.e621_create_poststr(None, post, include_post=True)
+    yield 'get_tagstr_first_page', lambda: bot.get_tagstr(post, 0)
+    yield 'get_tagstr_last_page', lambda: bot.get_tagstr(post, len(post.get_tag_pages()) - 1)
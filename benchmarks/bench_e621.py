@@ -0,0 +1,21 @@
+import copy
+
+import e6handler
+from common import FakeResponse, load_fixture, load_json_fixture
+
+
+def decode_page(response):
+    def run():
+        return e6handler.compact_posts(e6handler.decode_json(response)['posts'])
+    return run
+
+
+def compact(obj):
+    def run():
+        return e6handler.compact_post(copy.deepcopy(obj))
+    return run
+
+
+def benchmarks():
+    yield 'e621_decode_search_page', decode_page(FakeResponse(load_fixture('e621_search_page.json')))
+    yield 'e621_compact_post', compact(load_json_fixture('e621_post.json')['post'])
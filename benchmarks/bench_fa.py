@@ -0,0 +1,12 @@
+import fahandler
+from common import load_fixture
+
+POST_URL = 'https://www.furaffinity.net/view/45678901/'
+
+
+def benchmarks():
+    view = load_fixture('fa_view.html')
+    system_error = load_fixture('fa_system_error.html')
+
+    yield 'fa_parse_view', lambda: fahandler.parse_info(view, POST_URL, 'fabotaccount')
+    yield 'fa_parse_system_error', lambda: fahandler.parse_info(system_error, POST_URL, 'fabotaccount')
@@ -0,0 +1,34 @@
+import irc
+
+# Lines as they arrive from Libera with message-tags, account-tag and server-time enabled
+TAGGED_PRIVMSG = ("@account=someuser;msgid=Xq3bT9kLwYy2cZ8aJ1mN4p;time=2022-02-14T17:34:56.789Z "
+                  ":someuser!~someuser@user/someuser PRIVMSG ##furry-art :look at this "
+                  "https://www.furaffinity.net/view/45678901/ and https://e621.net/posts/3141592 :3")
+ESCAPED_TAGS = ("@+draft/reply=abc;+typing=active;label=a\\sb\\:c\\\\d;msgid=Xq3bT9kLwYy2cZ8aJ1mN4p "
+                ":nick!ident@host.example.com TAGMSG #channel")
+NUMERIC = ":tantalum.libera.chat 353 FAbot = ##furry-art :FAbot @ChanServ +someuser otheruser anotheruser thirduser"
+
+
+def parse(raw):
+    def run():
+        line = irc.IRCLine(raw)
+        line.parse()
+        return line
+    return run
+
+
+# __str__ caches the serialized line, so drop it each time to measure the serialization itself
+def to_str(line):
+    def run():
+        line.line = None
+        return str(line)
+    return run
+
+
+def benchmarks():
+    yield 'irc_parse_tagged_privmsg', parse(TAGGED_PRIVMSG)
+    yield 'irc_parse_escaped_tags', parse(ESCAPED_TAGS)
+    yield 'irc_parse_numeric', parse(NUMERIC)
+
+    yield 'irc_str_privmsg', to_str(irc.IRCLine(verb='PRIVMSG', params=['##furry-art', "[E621/3141592] Rating: Questionable | Score: 1222 (+1234/-12)"]))
+    yield 'irc_str_tagged_privmsg', to_str(parse(TAGGED_PRIVMSG)())
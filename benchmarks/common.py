@@ -0,0 +1,21 @@
+import json
+import os
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), 'rb') as fp:
+        return fp.read()
+
+
+def load_json_fixture(name):
+    return json.loads(load_fixture(name))
+
+
+# Just enough of requests.Response for the decoding helpers
+class FakeResponse:
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {}
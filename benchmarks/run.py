@@ -0,0 +1,145 @@
+# Offline benchmarks for the message pipeline. Each bench_* module exposes benchmarks(), yielding (name, fn) pairs
+# where fn runs one operation. Modules whose dependencies aren't installed are skipped.
+#
+#   python benchmarks/run.py                 compare against benchmarks/baseline.json
+#   python benchmarks/run.py --save          record a new baseline
+#   python benchmarks/run.py -k irc          only run benchmarks whose name contains "irc"
+#
+# Exits with status 1 if any benchmark got slower, or allocates more, than the baseline allows.
+
+import argparse
+import gc
+import importlib
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+BASELINE_FILE = os.path.join(BENCH_DIR, 'baseline.json')
+MODULES = ('bench_irc', 'bench_e621', 'bench_bot', 'bench_fa')
+RUN_SECS = 0.2
+REPEATS = 7
+DEFAULT_TOLERANCE = 0.25
+
+
+def get_machine():
+    return f"{platform.python_implementation()} {platform.python_version()} on {platform.machine()}"
+
+
+# Best of several timed runs, each sized to take about RUN_SECS
+def measure_speed(fn):
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= RUN_SECS / 10:
+            break
+        loops *= 10
+    loops = max(1, int(loops * RUN_SECS / elapsed))
+
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = (time.perf_counter() - start) / loops
+        best = elapsed if best is None else min(best, elapsed)
+    return 1 / best
+
+
+# Peak traced memory while one operation runs, and how many memory blocks its result keeps alive
+def measure_allocations(fn):
+    fn()  # warm up caches and interned strings first
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        start_size = tracemalloc.get_traced_memory()[0]
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1] - start_size
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    del result
+    return peak, max(blocks, 0)
+
+
+def load_benchmarks(name_filter):
+    for modname in MODULES:
+        try:
+            module = importlib.import_module(modname)
+        except ImportError as ex:
+            print(f"Skipping {modname}: {ex}")
+            continue
+        for name, fn in module.benchmarks():
+            if name_filter is None or name_filter in name:
+                yield name, fn
+
+
+def compare(name, result, baseline, tolerance):
+    if baseline is None:
+        return "(no baseline)", False
+    speed = result['ops_per_sec'] / baseline['ops_per_sec'] - 1
+    notes = [f"{speed:+.1%} ops/s"]
+    regressed = speed < -tolerance
+    if result['peak_bytes'] > baseline['peak_bytes'] * (1 + tolerance) + 256:
+        notes.append(f"peak {baseline['peak_bytes']} -> {result['peak_bytes']} B")
+        regressed = True
+    if result['blocks'] > baseline['blocks'] * (1 + tolerance) + 2:
+        notes.append(f"blocks {baseline['blocks']} -> {result['blocks']}")
+        regressed = True
+    return ', '.join(notes) + (" REGRESSION" if regressed else ''), regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the FAbot message pipeline")
+    parser.add_argument('--save', action='store_true', help="write the results as the new baseline")
+    parser.add_argument('-k', dest='name_filter', help="only run benchmarks whose name contains this")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help="allowed slowdown or growth (default: %(default)s)")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="baseline file (default: %(default)s)")
+    args = parser.parse_args()
+
+    baseline = {'machine': None, 'results': {}}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as fp:
+            baseline = json.load(fp)
+    if not args.save and baseline['machine'] not in (None, get_machine()):
+        print(f"Note: baseline was recorded with {baseline['machine']}, this is {get_machine()}")
+
+    results = {}
+    regressions = 0
+    print(f"{'benchmark':<32} {'ops/s':>12} {'peak B':>9} {'blocks':>7}  vs. baseline")
+    for name, fn in load_benchmarks(args.name_filter):
+        ops = measure_speed(fn)
+        peak, blocks = measure_allocations(fn)
+        result = {'ops_per_sec': round(ops, 1), 'peak_bytes': peak, 'blocks': blocks}
+        results[name] = result
+
+        note, regressed = compare(name, result, baseline['results'].get(name), args.tolerance)
+        regressions += regressed
+        print(f"{name:<32} {ops:>12,.0f} {peak:>9} {blocks:>7}  {note}")
+
+    if args.save:
+        if args.name_filter is not None:
+            results = dict(baseline['results'], **results)
+        with open(args.baseline, 'w') as fp:
+            json.dump({'machine': get_machine(), 'results': results}, fp, indent=2, sort_keys=True)
+            fp.write('\n')
+        print(f"Baseline written to {args.baseline}")
+    elif regressions:
+        print(f"{regressions} benchmark(s) regressed")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
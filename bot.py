@@ -1,29 +1,83 @@
 import asyncio
 import urllib.parse
 
+import cache
 import e6handler
 import irc
 import json
 import time
 import re
-import collections
+import functools
+import contextvars
+import traceback
 
 import fahandler
+import metrics
+import profiling
+import ratelimit
+import state
+import storage
+import tracing
+import watchdog
+import workqueue
 
 VALID_MD5 = re.compile('[\\da-f]{32}', re.IGNORECASE)
-
-
-def get_tagstr(tag_list):
-    tagstr = ''
-    added_tags = 0
-    for tag in tag_list:
-        if tagstr != '':
-            tagstr += ', '
-        tagstr += tag
-        added_tags += 1
-        if len(tagstr) > 350:
-            break
-    return tagstr, f" (and {len(tag_list) - added_tags} more)" if len(tag_list) > added_tags else '', tag_list[added_tags:]
+REJOIN_BASE_SECS = 5
+REJOIN_MAX_SECS = 600
+REJOIN_STABLE_SECS = 60
+REJOIN_SWEEP_SECS = 300
+CACHE_EXPIRE_FREQ_SECS = 60
+STORE_FLUSH_FREQ_SECS = 600
+E621_API_INTERVAL_SECS = 0.6
+DEFAULT_LOOKUP_CONCURRENCY = {'per_channel': 2, 'global': 4}
+DEFAULT_RANDOM_POOL = {'size': cache.RANDOM_POOL_SIZE, 'ttl': cache.RANDOM_POOL_TTL_SECS, 'watermark': cache.RANDOM_POOL_WATERMARK}
+SEARCH_PREFETCH_AT = 80
+SEARCH_MAX_NUMBERED_PAGE = 750
+BUSY_NOTICE_INTERVAL_SECS = 60
+STALL_LOG_INTERVAL_SECS = 30
+DEFAULT_QUOTAS = {
+    'user_lookups': {'rate': 0.2, 'burst': 6},
+    'user_commands': {'rate': 0.1, 'burst': 4},
+    'channel_lookups': {'rate': 0.5, 'burst': 15},
+    'channel_commands': {'rate': 0.25, 'burst': 8},
+    'shed_passive_backlog': 10,
+    'shed_command_backlog': 30
+}
+
+PM_COMMANDS = frozenset(('admin', 'die', 'addchan', 'delchan', 'listchans', 'reloadsec', 'config', 'clearrecent',
+                         'listoptout', 'stats', 'profile', 'optout', 'optin', 'help'))
+CHANNEL_COMMANDS = frozenset(('e6md5', 'search', 'random', 'e6random', 'rnd', 'e6rnd', 'e6search', 'e6tags', 'help'))
+
+COMMAND_SECONDS = metrics.histogram('bot_command_seconds', "Time spent handling bot commands", ('kind', 'command'))
+LOOKUP_SECONDS = metrics.histogram('bot_lookup_seconds', "Time spent expanding posted links", ('service',), always_on=True)
+CACHE_LOOKUPS = metrics.counter('bot_cache_lookups_total', "Cache lookups by namespace and result", ('namespace', 'result'), always_on=True)
+WORK_QUEUE_JOBS = metrics.gauge('bot_work_queue_jobs', "Jobs in the lookup work queue", ('state',))
+
+
+def count_cache_lookup(namespace, get, *args):
+    with tracing.span('cache', namespace=namespace) as span:
+        value = get(*args)
+        result = 'miss' if value is None else 'hit'
+        if span is not None:
+            span.attrs['result'] = result
+    CACHE_LOOKUPS.inc(namespace, result)
+    return value
+
+
+def extract_links(message):
+    famatches = list(dict.fromkeys(re.findall(fahandler.FURAFFINITY_POST_PATTERN, message)))
+    e6matches = list(dict.fromkeys(re.findall(e6handler.E621_POST_PATTERN, message)))
+    static1matches = list(dict.fromkeys(re.findall(e6handler.E621_IMAGE_PATTERN, message)))
+    return famatches, e6matches, static1matches
+
+
+def get_tagstr(post, page):
+    tag_list = post.get_tag_list()
+    pages = post.get_tag_pages()
+    start = pages[page - 1] if page > 0 else 0
+    end = pages[page]
+    tagstr = ', '.join(tag_list[start:end])
+    return tagstr, f" (and {len(tag_list) - end} more)" if len(tag_list) > end else '', page + 1 < len(pages)
 
 
 class FABot(irc.SASLIRCBot):
@@ -31,41 +85,147 @@ class FABot(irc.SASLIRCBot):
         super().__init__(secrets['sasluser'], secrets['saslpass'], require_auth=config['require_auth'], nick=config['nick'], ident=config['ident'], realname=config['realname'])
         self.__secrets = secrets
         self.logchan = config['logchan']
+
+        quotas = dict(DEFAULT_QUOTAS, **config.get('quotas', {}))
+        self.user_quotas = {kind: ratelimit.QuotaTable(quotas[f'user_{kind}']['rate'], quotas[f'user_{kind}']['burst']) for kind in ('lookups', 'commands')}
+        self.channel_quotas = {kind: ratelimit.QuotaTable(quotas[f'channel_{kind}']['rate'], quotas[f'channel_{kind}']['burst']) for kind in ('lookups', 'commands')}
+        self.shed_passive_backlog = quotas['shed_passive_backlog']
+        self.shed_command_backlog = quotas['shed_command_backlog']
+        self._busy_notices = ratelimit.QuotaTable(1 / BUSY_NOTICE_INTERVAL_SECS, 1, idle_secs=BUSY_NOTICE_INTERVAL_SECS)
+
+        concurrency = dict(DEFAULT_LOOKUP_CONCURRENCY, **config.get('lookup_concurrency', {}))
+        self.work_queue = workqueue.FairWorkQueue(concurrency['per_channel'], concurrency['global'])
+        self.e621_limiter = ratelimit.IntervalLimiter(E621_API_INTERVAL_SECS, 'e621')
+        WORK_QUEUE_JOBS.set_function(lambda: {('queued',): self.work_queue.queued, ('running',): self.work_queue.running})
+        metrics_config = config.get('metrics', {})
+        self.metrics_listen = None
+        self._metrics_server = None
+        if metrics_config.get('enabled'):
+            metrics.enable()
+            self.metrics_listen = metrics_config.get('listen')  # only ever bound to localhost by default
+        self.started = time.monotonic()
+        self._stats_mark = self.get_stats_counts()
+
+        self.watchdog = watchdog.LoopWatchdog(self.on_loop_stall, config.get('stall_threshold', watchdog.STALL_THRESHOLD_SECS))
+        self._stall_logs = ratelimit.TokenBucket(1 / STALL_LOG_INTERVAL_SECS, 3)
+        self.profile = profiling.ProfileSession()
+        tracing_config = config.get('tracing', {})
+        if tracing_config.get('file'):
+            tracing.configure(tracing_config['file'], tracing_config.get('threshold', tracing.SLOW_TRACE_SECS))
         self._load_bot_data('bot.json')
-        self.onchans = []
-        self._last_try_join_time = time.time()
-        self._last_e621_api_call = 0
+        self.onchans = set()
+        self._rejoins = {}
+        self._rejoin_pending = set()
+        self._rejoin_task = None
+
+        self.fa_info = cache.LookupCache()
+        self._refreshing = set()
+        self.negative_lookups = cache.NegativeCache()
+        self.e621_breaker = ratelimit.CircuitBreaker()
+        self.fa_breaker = ratelimit.CircuitBreaker()
+        self.e6_search_sessions = cache.SearchSessionCache()
+        random_pool = dict(DEFAULT_RANDOM_POOL, **config.get('random_pool', {}))
+        self.e6_random_pools = cache.RandomPoolCache(random_pool['size'], random_pool['ttl'], random_pool['watermark'])
+
+        self.e6_posts = cache.PostCache()
+        self.e6_reply_history = cache.ReplyHistory()
+
+        self.scheduler.call_every(CACHE_EXPIRE_FREQ_SECS, self.e6_reply_history.expire)
+        self.scheduler.call_every(CACHE_EXPIRE_FREQ_SECS, self.e6_search_sessions.expire)
+        self.scheduler.call_every(STORE_FLUSH_FREQ_SECS, self.store.flush)
 
-        self.fa_recent_lookups = collections.deque(maxlen=20)
-        self.e6_recent_post_lookups = collections.deque(maxlen=20)
-        self.e6_recent_md5_lookups = collections.deque(maxlen=20)
-        self.e6_recent_search_pages = collections.deque(maxlen=20)
+    def _load_bot_data(self, filename):
+        self.store = storage.JournaledStore(filename, {'channels': {}, 'admins': [], 'optout': []})
+        self.state = state.BotState(self.store)
 
-        self.e6_recent_post_replies = {}
-        self.e6_tag_more = {}
+    def close(self):
+        self.store.close()
 
-    def _load_bot_data(self, filename):
-        self.data_filename = filename
+    async def run(self, host, port, ssl=None):
+        if self.metrics_listen is not None:
+            self._metrics_server = await metrics.start_server(self.metrics_listen.get('host', '127.0.0.1'), self.metrics_listen['port'])
+        asyncio.current_task().set_name('irc connection')
+        self.watchdog.start(asyncio.get_running_loop())
         try:
-            with open(filename, 'r') as fp:
-                self.data = json.load(fp)
-        except IOError:
-            self.data = {'channels': {}, 'admins': [], 'optout': []}
-            self._save_bot_data()
-
-    def _save_bot_data(self):
-        with open(self.data_filename, 'w') as fp:
-            json.dump(self.data, fp)
+            await super().run(host, port, ssl)
+        finally:
+            self.watchdog.stop()
+            if self._metrics_server is not None:
+                self._metrics_server.close()
+                self._metrics_server = None
+
+    def on_loop_stall(self, report):
+        print(f"Event loop blocked for {report.duration:.2f}s in {report.task}:")
+        print(''.join(traceback.format_list(report.stack)), end='')
+        if self._stall_logs.try_take():
+            asyncio.ensure_future(self.send_log('watchdog', f"Event loop blocked for \2{report.duration:.2f}s\2 in {report.task}: {report.summary()}"))
+
+    async def finish_profile(self, source=None):
+        if not self.profile.active:
+            return
+        owner = self.profile.owner
+        filename = self.profile.get_filename()
+        summary = await self.run_blocking(profiling.write_profile, self.profile.stop(), filename)
+        await self.send_log('profile', f"Profile written to {filename}")
+        for target in {owner, source} - {None}:
+            await self.send_notice(target, f"Profile written to {filename}. Top {len(summary)} by self time:")
+            for entry in summary:
+                await self.send_notice(target, entry)
+
+    def get_stats_counts(self):
+        lines = irc.IRC_LINES.collect()
+        cache_lookups = CACHE_LOOKUPS.collect()
+        return {'time': time.monotonic(),
+                'lines_in': sum(v for k, v in lines.items() if k[0] == 'in'),
+                'lines_out': sum(v for k, v in lines.items() if k[0] == 'out'),
+                'lookups': LOOKUP_SECONDS.bucket_counts(),
+                'cache_hits': sum(v for k, v in cache_lookups.items() if k[1] == 'hit'),
+                'cache_total': sum(cache_lookups.values())}
+
+    # Rates cover the time since the previous stats call
+    def get_stats(self):
+        now, mark = self.get_stats_counts(), self._stats_mark
+        self._stats_mark = now
+        window = max(now['time'] - mark['time'], 1e-3)
+        uptime = now['time'] - self.started
+        days, rem = divmod(int(uptime), 86400)
+        stats = [f"Uptime {days}d {rem // 3600}h {rem % 3600 // 60}m (rates over the last {window:.0f}s)"]
+
+        stats.append(f"lines {(now['lines_in'] - mark['lines_in']) / window:.2f}/s in, {(now['lines_out'] - mark['lines_out']) / window:.2f}/s out")
+
+        lookups = f"lookups {(sum(now['lookups']) - sum(mark['lookups'])) / window:.3f}/s"
+        p50 = LOOKUP_SECONDS.quantile(0.5, since=mark['lookups'])
+        if p50 is not None:
+            p99 = LOOKUP_SECONDS.quantile(0.99, since=mark['lookups'])
+            lookups += f", p50 {p50 * 1000:.0f}ms, p99 {p99 * 1000:.0f}ms"
+        stats.append(lookups)
+
+        hits = now['cache_hits'] - mark['cache_hits']
+        total = now['cache_total'] - mark['cache_total']
+        stats.append(f"cache hit {hits / total:.0%} of {total}" if total else "cache hit n/a")
+
+        stats.append(f"queue {self.work_queue.queued} queued, {self.work_queue.running} running, {len(self.e621_limiter)} waiting on e621")
+        return ' | '.join(stats)
 
     def add_e621_post_reply(self, chan, post):
-        targetchan = chan.lower()
-        if targetchan in self.e6_recent_post_replies:
-            recents = self.e6_recent_post_replies[targetchan]
-        else:
-            recents = collections.deque(maxlen=20)
-            self.e6_recent_post_replies[targetchan] = recents
-
-        recents.appendleft(post)
+        self.e6_posts.add(post)
+        self.e6_reply_history.add(chan.lower(), post.id)
+
+    async def get_e621_post_reply(self, chan, histidx, source):
+        post_id = self.e6_reply_history.get(chan.lower(), histidx)
+        if post_id is None:
+            return None
+        return await self.get_e621_post(post_id, chan, source)
+
+    async def get_e621_post(self, post_id, chan, source):
+        post = self.e6_posts.get(post_id)
+        if post is None:
+            await self.send_log('E621', f"Re-fetching evicted post \2{post_id}\2 (requested by {source} in {chan})")
+            post = await self.e621_request(e6handler.get_post_info, str(post_id))
+            if type(post) is dict and 'error' in post:
+                await self.send_log('E621', f"Lookup failed for \2{post_id}\2: Error: {post['error']}")
+                return None
+        return post
 
     async def send_message(self, target, message):
         await self.write_line(irc.IRCLine(verb='PRIVMSG', params=[target, message]))
@@ -79,46 +239,111 @@ class FABot(irc.SASLIRCBot):
     async def on_register(self):
         await super().on_register()
         await self.write_line(irc.IRCLine(verb='MODE', params=[self.nick, '+Qu-iw']))
-        await self.send_log('bot', f'Successfully connected and registered with account {self.account}')
+        await self.send_log('bot', f"Successfully connected and registered with account {self.account} in {self.timings['connect_to_001']:.2f}s")
 
-        for channame in self.data['channels']:
-            channel = self.data['channels'][channame]
-            if 'key' in channel:
-                await self.join(channame, channel['key'])
-            else:
-                await self.join(channame)
+        await self.join_many([(channame, policy.key) for channame, policy in self.state.channels.items()])
+        self._connection_timers.append(self.scheduler.call_every(REJOIN_SWEEP_SECS, self._sweep_rejoins))
+
+    async def on_disconnect(self):
+        await super().on_disconnect()
+        self.onchans.clear()
+        for channame in list(self._rejoins):
+            self.cancel_rejoin(channame)
+
+    def schedule_rejoin(self, channame):
+        if channame not in self.state.channels or channame in self.onchans:
+            return
+        attempts, handle = self._rejoins.get(channame, (0, None))
+        if handle is not None:
+            handle.cancel()
+        delay = min(REJOIN_BASE_SECS * 2 ** attempts, REJOIN_MAX_SECS)
+        handle = self.scheduler.call_later(delay, self._rejoin_due, channame)
+        self._rejoins[channame] = (attempts + 1, handle)
+
+    # The backoff is only reset once the channel has stayed joined for a while
+    def _rejoin_stable(self, channame):
+        if channame in self.onchans:
+            self._rejoins.pop(channame, None)
+
+    # Retries joins that failed without a handled error or got no reply
+    def _sweep_rejoins(self):
+        for channame in self.state.channels:
+            if channame in self.onchans or channame in self._rejoin_pending:
+                continue
+            if self._rejoins.get(channame, (0, None))[1] is None:
+                self.schedule_rejoin(channame)
+
+    def cancel_rejoin(self, channame):
+        attempts, handle = self._rejoins.pop(channame, (0, None))
+        if handle is not None:
+            handle.cancel()
+        self._rejoin_pending.discard(channame)
+
+    def _rejoin_due(self, channame):
+        if channame in self._rejoins:
+            self._rejoins[channame] = (self._rejoins[channame][0], None)
+        self._rejoin_pending.add(channame)
+        if self._rejoin_task is None:
+            self._rejoin_task = asyncio.ensure_future(self._flush_rejoins())
+
+    async def _flush_rejoins(self):
+        try:
+            pending = [channame for channame in self._rejoin_pending if channame in self.state.channels and channame not in self.onchans]
+            self._rejoin_pending.clear()
+            await self.join_many([(channame, self.state.channels[channame].key) for channame in pending])
+        finally:
+            self._rejoin_task = None
 
     async def handle_verb_join(self, line):
         channel = line.params[0].lower()
         if line.source['nick'] == self.nick:
-            if channel not in self.onchans:
-                self.onchans.append(channel)
+            self.onchans.add(channel)
+            attempts, handle = self._rejoins.get(channel, (0, None))
+            self.cancel_rejoin(channel)
+            if attempts > 0:
+                self._rejoins[channel] = (attempts, self.scheduler.call_later(REJOIN_STABLE_SECS, self._rejoin_stable, channel))
+
+            if 'connect_to_joined' not in self.timings and self.onchans.issuperset(self.state.channels):
+                self.timings['connect_to_joined'] = time.monotonic() - self._connect_started
+                await self.send_log('bot', f"Joined all {len(self.onchans)} channels {self.timings['connect_to_joined']:.2f}s after connecting")
 
     async def handle_verb_part(self, line):
         channel = line.params[0].lower()
         if line.source['nick'] == self.nick:
-            if channel in self.onchans:
-                self.onchans.remove(channel)
+            self.onchans.discard(channel)
+            self.e6_reply_history.drop(channel)
+            self.schedule_rejoin(channel)
 
     async def handle_verb_kick(self, line):
         channel = line.params[0].lower()
         kicked = line.params[1]
-        if channel in self.onchans and kicked == self.nick:
-            self.onchans.remove(channel)
-
-    async def tick_client(self):
-        await super().tick_client()
-
-        now = time.time()
-        if now - self._last_try_join_time > 10:
-            self._last_try_join_time = now
-            for channame in self.data['channels']:
-                if channame not in self.onchans:
-                    channel = self.data['channels'][channame]
-                    if 'key' in channel:
-                        await self.join(channame, channel['key'])
-                    else:
-                        await self.join(channame)
+        if kicked == self.nick:
+            self.onchans.discard(channel)
+            self.schedule_rejoin(channel)
+
+    async def handle_join_error(self, line):
+        self.schedule_rejoin(line.params[1].lower())
+
+    async def handle_verb_437(self, line):  # ERR_UNAVAILRESOURCE
+        await self.handle_join_error(line)
+
+    async def handle_verb_471(self, line):  # ERR_CHANNELISFULL
+        await self.handle_join_error(line)
+
+    async def handle_verb_473(self, line):  # ERR_INVITEONLYCHAN
+        await self.handle_join_error(line)
+
+    async def handle_verb_474(self, line):  # ERR_BANNEDFROMCHAN
+        await self.handle_join_error(line)
+
+    async def handle_verb_475(self, line):  # ERR_BADCHANNELKEY
+        await self.handle_join_error(line)
+
+    async def handle_verb_477(self, line):  # ERR_NEEDREGGEDNICK
+        await self.handle_join_error(line)
+
+    async def handle_verb_480(self, line):  # join throttled
+        await self.handle_join_error(line)
 
     async def handle_verb_privmsg(self, line):
         target = line.params[0]
@@ -134,54 +359,189 @@ class FABot(irc.SASLIRCBot):
         if target == self.nick and not is_ctcp:  # PM command
             splt = message.split(' ')
             try:
-                await asyncio.wait_for(self.handle_pm_command(line, splt[0].lower(), splt[1:]), 5.0)
+                command = splt[0].lower()
+                with COMMAND_SECONDS.time('pm', command if command in PM_COMMANDS else 'other'):
+                    await asyncio.wait_for(self.handle_pm_command(line, command, splt[1:]), 5.0)
             except asyncio.TimeoutError:
                 await self.send_notice(line.source['nick'], "The command could not be completed in time.")
-        elif target.lower() in self.data['channels']:
+        elif target.lower() in self.state.channels:
             if message == '': return  # Not traditionally possible, but allowed by the protocol
-            targetchan = target.lower()
-
-            prefixes = ''
-            if 'prefix' in self.data['channels'][targetchan]:
-                prefixes = self.data['channels'][targetchan]['prefix']
+            policy = self.state.channels[target.lower()]
 
-            if message[0] in prefixes:
+            if message[0] in policy.prefixes:
                 stripmsgsplt = message[1:].split(' ')
-                await self.handle_channel_command(line, stripmsgsplt[0].lower(), stripmsgsplt[1:])
+                await self.dispatch_channel_command(line, stripmsgsplt[0].lower(), stripmsgsplt[1:])
             elif re.match(f'^{re.escape(self.nick)}[:,]? ', message, re.IGNORECASE):
                 splt = message.split(' ')
                 if len(splt) < 2: return
-                await self.handle_channel_command(line, splt[1].lower(), splt[2:])
+                await self.dispatch_channel_command(line, splt[1].lower(), splt[2:])
             else:
-                opted_out = 'account' in line.tags and line.tags['account']['value'].lower() in self.data['optout']
+                opted_out = 'account' in line.tags and self.state.is_opted_out(line.tags['account']['value'])
 
                 if not opted_out:
-                    await self.handle_furaffinity(message, line, target)
-                    await self.handle_e621_posts(message, line, target)
-                    await self.handle_e621_static1(message, line, target)
+                    await self.dispatch_lookups(message, line, target)
+
+    @staticmethod
+    def quota_key(line):
+        if 'account' in line.tags:
+            return 'account:' + line.tags['account']['value'].lower()
+        return f"host:{line.source['ident']}@{line.source['host']}".lower()
+
+    async def send_busy(self, line, message):
+        if self._busy_notices.try_take(self.quota_key(line)):
+            await self.send_notice(line.source['nick'], message)
+
+    # Returns how much of cost was admitted; lookups are shed at a lower backlog than commands
+    async def admit_work(self, line, targetchan, kind, cost=1):
+        threshold = self.shed_passive_backlog if kind == 'lookups' else self.shed_command_backlog
+        backlog = self.work_queue.backlog
+        if backlog >= threshold:
+            await self.send_log('load', f"Shed {kind} from {line.sourceraw} in {targetchan} (backlog {backlog})")
+            await self.send_busy(line, "I'm busy right now, please try again in a minute.")
+            return 0
+
+        user_key = self.quota_key(line)
+        user_quota = self.user_quotas[kind]
+        channel_quota = self.channel_quotas[kind]
+        granted = min(cost, int(user_quota.available(user_key)), int(channel_quota.available(targetchan)))
+        if granted < cost:
+            await self.send_log('load', f"Quota exceeded for {kind} from {line.sourceraw} in {targetchan} ({granted} of {cost} admitted)")
+        if granted == 0:
+            await self.send_busy(line, "You're sending requests too quickly, please slow down.")
+            return 0
+
+        user_quota.try_take(user_key, granted)
+        channel_quota.try_take(targetchan, granted)
+        return granted
+
+    async def dispatch_channel_command(self, line, command, params):
+        if command not in CHANNEL_COMMANDS:
+            return  # other bots' commands and chatter aimed at us aren't charged to anyone's quota
+        if await self.admit_work(line, line.params[0].lower(), 'commands'):
+            self.work_queue.submit(line.params[0].lower(), self.run_channel_command, line, command, params)
+
+    async def run_channel_command(self, line, command, params):
+        asyncio.current_task().set_name(f"command {command} in {line.params[0]}")
+        with COMMAND_SECONDS.time('channel', command):
+            await self.handle_channel_command(line, command, params)
+
+    @staticmethod
+    async def run_lookup(service, handler, *args):
+        asyncio.current_task().set_name(f"lookup {service} in {args[-1]}")
+        with LOOKUP_SECONDS.time(service):
+            await handler(*args)
+
+    async def dispatch_lookups(self, message, line, target):
+        famatches, e6matches, static1matches = extract_links(message)
+        cost = len(famatches) + len(e6matches) + len(static1matches)
+        if cost == 0:
+            return
+        with tracing.span('admit'):
+            granted = await self.admit_work(line, target.lower(), 'lookups', cost)
+        if granted == 0:
+            return
+        if granted < cost:
+            famatches = famatches[:granted]
+            e6matches = e6matches[:granted - len(famatches)]
+            static1matches = static1matches[:granted - len(famatches) - len(e6matches)]
+            await self.send_busy(line, f"Only looking up {granted} of the {cost} links in your message, the rest were skipped.")
 
-    async def handle_furaffinity(self, message, line, target):
-        famatches = list(dict.fromkeys(re.findall(fahandler.FURAFFINITY_POST_PATTERN, message)))
-        now = time.time()
+        targetchan = target.lower()
+        if famatches:
+            self.work_queue.submit(targetchan, self.run_lookup, 'furaffinity', self.handle_furaffinity, famatches, line, target)
+        if e6matches:
+            self.work_queue.submit(targetchan, self.run_lookup, 'e621', self.handle_e621_posts, e6matches, line, target)
+        if static1matches:
+            self.work_queue.submit(targetchan, self.run_lookup, 'e621_md5', self.handle_e621_static1, static1matches, line, target)
+
+    # run_in_executor doesn't copy contextvars by itself
+    @staticmethod
+    async def run_blocking(fn, *args, **kwargs):
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(context.run, fn, *args, **kwargs))
+
+    # Breaker first, so refused requests don't take a limiter slot
+    async def guarded_request(self, note, breaker, fn, *args, limiter=None, priority=ratelimit.PRIORITY_NORMAL, **kwargs):
+        if not breaker.allow():
+            return {'error': "Lookups are paused after repeated authentication failures", 'kind': 'auth'}
+        if limiter is not None:
+            with tracing.span('ratelimit_wait'):
+                await limiter.wait(priority)
+
+        result = await self.run_blocking(fn, *args, **kwargs)
+        if type(result) is dict and result.get('kind') == 'auth':
+            if breaker.record_failure():
+                await self.send_log(note, f"Authentication failing, pausing lookups for {breaker.cooldown} seconds: {result['error']}")
+        else:
+            breaker.record_success()
+        return result
+
+    async def e621_request(self, fn, *args, priority=ratelimit.PRIORITY_NORMAL, **kwargs):
+        with tracing.span('upstream', service='e621', call=fn.__name__):
+            result = await self.guarded_request('E621', self.e621_breaker, fn, self.__secrets['auth']['e621'], *args,
+                                                limiter=self.e621_limiter, priority=priority, **kwargs)
+        self.e6_posts.add_result(result)
+        return result
+
+    async def fa_request(self, fn, *args, **kwargs):
+        with tracing.span('upstream', service='furaffinity', call=fn.__name__):
+            return await self.guarded_request('FA', self.fa_breaker, fn, self.__secrets['auth']['furaffinity'], *args, **kwargs)
+
+    # Only one refresh per key is in flight
+    def refresh_in_background(self, key, fn, *args):
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+        self.scheduler.call_later(0, self._refresh, key, fn, *args)
 
+    async def _refresh(self, key, fn, *args):
+        try:
+            await fn(*args)
+        finally:
+            self._refreshing.discard(key)
+
+    async def _refresh_fa_info(self, match):
+        info = await self.fa_request(fahandler.get_info, match)
+        if 'error' not in info:
+            self.fa_info.put(match, info)
+        elif info.get('kind') == 'notfound':
+            self.fa_info.discard(match)
+            self.negative_lookups.add_error(('fa', match), info)
+
+    async def _refresh_e621_post(self, post_id):
+        post = await self.e621_request(e6handler.get_post_info, str(post_id), priority=ratelimit.PRIORITY_LOW)
+        if type(post) is dict and post.get('kind') == 'notfound':
+            self.e6_posts.discard(post_id)
+
+    async def _refresh_e621_md5(self, md5_hash, post_id):
+        results = await self.e621_request(e6handler.search_post_hash, md5_hash, priority=ratelimit.PRIORITY_LOW)
+        if type(results) is list and not results:
+            self.e6_posts.discard(post_id)
+
+    async def handle_furaffinity(self, famatches, line, target):
         targetchan = target.lower()
-        chandata = self.data['channels'][targetchan]
-        allow_nsfw = 'nsfw' in chandata and chandata['nsfw'] == 'true'
+        policy = self.state.channels[targetchan]
+        allow_nsfw = policy.allow_nsfw
 
         for match in famatches:
             try:
-                info = None
-                for lookup in self.fa_recent_lookups:
-                    if lookup[0] == match and now - lookup[1] < 300:
-                        await self.send_log('FA',
-                                            f"Found cached post \2{match}\2 (requested by {line.sourceraw} in {target})")
-                        info = lookup[2]
+                info = count_cache_lookup('fa_info', self.fa_info.get_fresh, match)
+                if info is not None:
+                    await self.send_log('FA',
+                                        f"Found cached post \2{match}\2 (requested by {line.sourceraw} in {target})")
+                    if self.fa_info.is_stale(match):
+                        self.refresh_in_background(('fa', match), self._refresh_fa_info, match)
+                else:
+                    info = count_cache_lookup('negative', self.negative_lookups.get, ('fa', match))
 
                 if info is None:
                     await self.send_log('FA',
                                         f"Looking up post \2{match}\2 (requested by {line.sourceraw} in {target})")
-                    info = fahandler.get_info(self.__secrets['auth']['furaffinity'], match)
-                    self.fa_recent_lookups.append((match, now, info))
+                    info = await self.fa_request(fahandler.get_info, match)
+                    if 'error' in info:
+                        self.negative_lookups.add_error(('fa', match), info)
+                    else:
+                        self.fa_info.put(match, info)
 
                 if 'error' in info:
                     await self.send_log('FA', f"Lookup failed for \2{match}\2: Error: {info['error']}")
@@ -212,9 +572,10 @@ class FABot(irc.SASLIRCBot):
                 await self.send_log('FA', f"Lookup failed for \2{match}\2: Exception raised: {type(ex).__name__}: {str(ex)}")
                 #await self.send_message(target, f"[FA/{match}] Error: An exception occurred while parsing the webpage.")
 
-    def e621_create_poststr(self, post, include_post=False):
+    @tracing.traced('format')
+    def e621_create_poststr(self, post, include_post=False, blacklist=e6handler.BLACKLIST_POST):
         artists: str
-        artist_tags = post['tags']['artist']
+        artist_tags = post.tags['artist']
         if len(artist_tags) == 1:
             artists = artist_tags[0]
         elif len(artist_tags) == 0:
@@ -225,67 +586,57 @@ class FABot(irc.SASLIRCBot):
             artists = f"{', '.join(artist_tags[:3])} (and {len(artist_tags) - 3} more)"
 
         post_blacklisted = False
-        if post['rating'] != 's':
+        if post.rating != 's':
             for tag in e6handler.BLACKLIST_SAFE:
-                if tag in post['tags']['general']:
-                    post_blacklisted = True
-                    break
-
-        if not post_blacklisted:
-            for tag in e6handler.BLACKLIST_GENERAL:
-                if tag in post['tags']['general']:
+                if tag in post.tags['general']:
                     post_blacklisted = True
                     break
 
         if not post_blacklisted:
-            for tag in e6handler.BLACKLIST_GENERAL_POST:
-                if tag in post['tags']['general']:
+            for tag in post.tags['general']:
+                if tag in blacklist:
                     post_blacklisted = True
                     break
 
-        poststr = f"[E621/{'(blacklisted)' if post_blacklisted else post['id']}] "
+        poststr = f"[E621/{'(blacklisted)' if post_blacklisted else post.id}] "
 
-        total_votes = post['score']['up'] + abs(post['score']['down'])
+        total_votes = post.score_up + abs(post.score_down)
         if total_votes > 0:
-            upvote_percent = (post['score']['up'] / total_votes) * 100
+            upvote_percent = (post.score_up / total_votes) * 100
         else:
             upvote_percent = 0
 
-        poststr += f"Art by {artists} | Rating: {e6handler.get_rating(post['rating'])} | Score: {post['score']['total']:+} ({upvote_percent:.0f}%) | "
-        if post['flags']['deleted']:
+        poststr += f"Art by {artists} | Rating: {e6handler.get_rating(post.rating)} | Score: {post.score_total:+} ({upvote_percent:.0f}%) | "
+        if post.deleted:
             poststr += "Post is deleted | "
-        elif post['flags']['flagged']:
+        elif post.flagged:
             poststr += "Post is flagged for deletion | "
 
         if include_post:
             if post_blacklisted:
                 poststr += f"Post: (blacklisted) | "
             else:
-                poststr += f"Post: https://{'e926' if post['rating'] == 's' else 'e621'}.net/posts/{post['id']} | "
+                poststr += f"Post: https://{'e926' if post.rating == 's' else 'e621'}.net/posts/{post.id} | "
 
         content_warning = set()
-        if post['rating'] != 's':
+        if post.rating != 's':
             for bls in e6handler.BLACKLIST_SAFE:
-                if bls in post['tags']['general']:
+                if bls in post.tags['general']:
                     content_warning.add(bls)
-        for bl in e6handler.BLACKLIST_GENERAL:
-            if bl in post['tags']['general']:
+        for bl in post.tags['general']:
+            if bl in blacklist:
                 content_warning.add(bl)
-        for blp in e6handler.BLACKLIST_GENERAL_POST:
-            if blp in post['tags']['general']:
-                content_warning.add(blp)
         for cw in e6handler.CONTENT_WARNING_GENERAL:
-            if cw in post['tags']['general']:
+            if cw in post.tags['general']:
                 content_warning.add(cw)
 
-        if 'file' in post:
-            file_obj = post['file'] or {'width': None, 'height': None, 'url': None}
-            file_url = file_obj['url']
+        if post.has_file:
+            file_url = post.file_url
             if file_url is not None and post_blacklisted:
                 file_url = "(blacklisted)"
-            if file_url is not None and post['rating'] == 's':
+            if file_url is not None and post.rating == 's':
                 file_url = file_url.replace("static1.e621.net", "static1.e926.net", 1)
-            poststr += f"Image ({file_obj['width'] or '?'}x{file_obj['height'] or '?'}): {file_url or '(unknown)'}"
+            poststr += f"Image ({post.file_width or '?'}x{post.file_height or '?'}): {file_url or '(unknown)'}"
         else:
             poststr += f"Image (?x?): (unknown)"
 
@@ -294,73 +645,122 @@ class FABot(irc.SASLIRCBot):
 
         return poststr
 
-    async def e621_ratelimit_wait(self):
-        now = time.time()
-        since_last = now - self._last_e621_api_call
-        if since_last < 0.6:
-            await asyncio.sleep(0.6 - since_last)
-
-    async def handle_e621_posts(self, message, line, target):
-        e6matches = list(dict.fromkeys(re.findall(e6handler.E621_POST_PATTERN, message)))
-        now = time.time()
-
+    async def handle_e621_posts(self, e6matches, line, target):
         targetchan = target.lower()
-        chandata = self.data['channels'][targetchan]
-        allow_nsfw = 'nsfw' in chandata and chandata['nsfw'] == 'true'
+        policy = self.state.channels[targetchan]
+        allow_nsfw = policy.allow_nsfw
 
         for match in e6matches:
             try:
-                post = None
-                for lookup in self.e6_recent_post_lookups:
-                    if lookup[0] == match and now - lookup[1] < 300:
-                        await self.send_log('E621', f"Found cached post \2{match}\2 (requested by {line.sourceraw} in {target})")
-                        post = lookup[2]
-
-                if post is None:
+                post = count_cache_lookup('e621_post', self.e6_posts.get_fresh, int(match))
+                if post is not None and self.e6_posts.is_stale(post):
+                    self.refresh_in_background(('e621', post.id), self._refresh_e621_post, post.id)
+                post = post or count_cache_lookup('negative', self.negative_lookups.get, ('e621', match))
+                if post is not None:
+                    await self.send_log('E621', f"Found cached post \2{match}\2 (requested by {line.sourceraw} in {target})")
+                else:
                     await self.send_log('E621', f"Looking up post \2{match}\2 (requested by {line.sourceraw} in {target})")
-                    await self.e621_ratelimit_wait()
-                    now = time.time()
-                    post = e6handler.get_post_info(self.__secrets['auth']['e621'], match)
-                    self._last_e621_api_call = now
-                    self.e6_recent_post_lookups.append((match, now, post))
+                    post = await self.e621_request(e6handler.get_post_info, match)
+                    if type(post) is dict and 'error' in post:
+                        self.negative_lookups.add_error(('e621', match), post)
 
-                if 'error' in post:
+                if type(post) is dict and 'error' in post:
                     await self.send_log('E621', f"Lookup failed for \2{match}\2: Error: {post['error']}")
                     await self.send_message(target, f"[E621/{match}] Error: {post['error']}")
                     continue
 
-                poststr = self.e621_create_poststr(post)
+                poststr = self.e621_create_poststr(post, blacklist=policy.blacklist)
                 await self.send_log('E621', f"Lookup succeeded for \2{match}\2: {poststr}")
 
-                if allow_nsfw or post['rating'] == 's':
+                if allow_nsfw or post.rating == 's':
                     self.add_e621_post_reply(targetchan, post)
                     await self.send_message(target, poststr)
             except Exception as ex:
                 await self.send_log('E621', f"Lookup failed for \2{match}\2: Exception raised: {type(ex).__name__}: {str(ex)}")
                 await self.send_message(target, f"[E621/{match}] Error: An exception occurred while querying post info.")
 
+    def prefetch_search_page(self, session, pageidx):
+        if pageidx in session.prefetching or session.get_page(pageidx) is not None or not session.has_next_page(pageidx - 1):
+            return
+        session.prefetching.add(pageidx)
+        self.scheduler.call_later(0, self._prefetch_search_page, session, pageidx)
+
+    async def _prefetch_search_page(self, session, pageidx):
+        try:
+            cursor = session.cursor_for(pageidx)
+            if cursor is None and pageidx >= SEARCH_MAX_NUMBERED_PAGE:
+                return
+            await self.fetch_search_page(session, pageidx, cursor, priority=ratelimit.PRIORITY_LOW)
+        finally:
+            session.prefetching.discard(pageidx)
+
+    async def fetch_search_page(self, session, pageidx, cursor, priority=ratelimit.PRIORITY_NORMAL):
+        stale_results = session.get_page(pageidx, max_age=cache.SEARCH_PAGE_KEEP_SECS)
+        validators = session.get_validators(pageidx) if stale_results is not None else {}
+        page_results = await self.e621_request(e6handler.search_post_tags, session.query, session.sfw, page=cursor or pageidx + 1,
+                                               validators=validators, priority=priority)
+        if page_results is e6handler.NOT_MODIFIED:
+            page_results = stale_results
+        elif type(page_results) is dict and 'error' in page_results:
+            return page_results
+        session.put_page(pageidx, page_results, validators)
+        return page_results
+
+    async def e621_random_post(self, tags, sfw):
+        query = e6handler.normalize_query(tags)
+        if e6handler.is_ordered_query(query):
+            return await self.e621_request(e6handler.search_post_random, query, sfw)  # can't be pooled
+
+        pool = self.e6_random_pools.get(query, sfw)
+        CACHE_LOOKUPS.inc('random_pool', 'hit' if pool.posts else 'miss')
+        if not pool.posts:
+            posts = await self.e621_request(e6handler.search_post_random_batch, query, sfw, self.e6_random_pools.size)
+            if type(posts) is dict and 'error' in posts:
+                return posts
+            if not posts:
+                return {'error': "No posts were found by those tags", 'kind': 'notfound'}
+            pool.fill(posts)
+
+        post = pool.posts.popleft()
+        if self.e6_random_pools.needs_refill(pool):
+            pool.refilling = True
+            self.scheduler.call_later(0, self._refill_random_pool, pool)
+        return post
+
+    async def _refill_random_pool(self, pool):
+        try:
+            posts = await self.e621_request(e6handler.search_post_random_batch, pool.query, pool.sfw, self.e6_random_pools.size, priority=ratelimit.PRIORITY_LOW)
+            if type(posts) is list and posts:
+                pool.fill(posts)  # the few leftovers are dropped so the TTL still bounds the age of every post
+        finally:
+            pool.refilling = False
+
     async def e621_search_md5(self, md5_hash, source, target):
-        now = time.time()
-        results = None
-        for lookup in self.e6_recent_md5_lookups:
-            if lookup[0] == md5_hash and now - lookup[1] < 300:
-                await self.send_log('E621', f"Found cached post \2{md5_hash}\2 (requested by {source} in {target})")
-                results = lookup[2]
-                break
-
-        if results is None:
-            await self.send_log('E621', f"Searching for post \2{md5_hash}\2 (requested by {source} in {target})")
-            await self.e621_ratelimit_wait()
-            now = time.time()
-            results = e6handler.search_post_hash(self.__secrets['auth']['e621'], md5_hash)
-            self.e6_recent_md5_lookups.append((md5_hash, now, results))
+        post = count_cache_lookup('e621_md5', self.e6_posts.get_fresh_md5, md5_hash)
+        if post is not None:
+            if self.e6_posts.is_stale(post):
+                self.refresh_in_background(('e621-md5', post.md5), self._refresh_e621_md5, post.md5, post.id)
+            await self.send_log('E621', f"Found cached post \2{md5_hash}\2 (requested by {source} in {target})")
+            return [post]
+
+        key = ('e621-md5', md5_hash.lower())
+        results = count_cache_lookup('negative', self.negative_lookups.get, key)
+        if results is not None:
+            await self.send_log('E621', f"Found cached search \2{md5_hash}\2 (requested by {source} in {target})")
+            return results
+
+        await self.send_log('E621', f"Searching for post \2{md5_hash}\2 (requested by {source} in {target})")
+        results = await self.e621_request(e6handler.search_post_hash, md5_hash)
+        if type(results) is dict and 'error' in results:
+            self.negative_lookups.add_error(key, results)
+        elif not results:
+            self.negative_lookups.add(key, 'notfound', results)
         return results
 
-    async def handle_e621_static1(self, message, line, target):
-        e6matches = list(dict.fromkeys(re.findall(e6handler.E621_IMAGE_PATTERN, message)))
+    async def handle_e621_static1(self, e6matches, line, target):
         targetchan = target.lower()
-        chandata = self.data['channels'][targetchan]
-        allow_nsfw = 'nsfw' in chandata and chandata['nsfw'] == 'true'
+        policy = self.state.channels[targetchan]
+        allow_nsfw = policy.allow_nsfw
 
         for match in e6matches:
             try:
@@ -375,16 +775,16 @@ class FABot(irc.SASLIRCBot):
             await self.send_log('E621', f"Search succeeded for \2{match[1]}\2: {len(results)} post(s) found.")
 
             for post in results:
-                if post['rating'] != 's' and not allow_nsfw:
+                if post.rating != 's' and not allow_nsfw:
                     continue
 
-                poststr = self.e621_create_poststr(post, include_post=True)
+                poststr = self.e621_create_poststr(post, include_post=True, blacklist=policy.blacklist)
                 self.add_e621_post_reply(targetchan, post)
                 await self.send_message(target, poststr)
 
     async def handle_pm_command(self, line, command, params):
         source = line.source['nick']
-        is_admin = 'account' in line.tags and line.tags['account']['value'].lower() in self.data['admins']
+        is_admin = 'account' in line.tags and self.state.is_admin(line.tags['account']['value'])
 
         if command == 'admin' and is_admin:
             await self.handle_admin_command(line, params)
@@ -394,24 +794,18 @@ class FABot(irc.SASLIRCBot):
                 msg = ' '.join(params)
             await self.send_log('bot', f'Received die command from {line.sourceraw} - "{msg}"')
             await self.quit(msg)
+            self.shutdown()
         elif command == 'addchan' and is_admin:
             if len(params) < 1 or len(params) > 2:
                 await self.send_notice(source, "Usage: addchan <channel> [key]")
                 return
             channame = params[0].lower()
-            if channame in self.data['channels']:
+            if channame in self.state.channels:
                 await self.send_notice(source, "I'm already in that channel.")
                 return
-            chan = {}
-            if len(params) > 1:
-                chan['key'] = params[1]
-            self.data['channels'][channame] = chan
-            self._save_bot_data()
-
-            if 'key' in chan:
-                await self.join(channame, chan['key'])
-            else:
-                await self.join(channame)
+            key = params[1] if len(params) > 1 else None
+            self.state.add_channel(channame, key)
+            await self.join(channame, key)
             await self.send_notice(source, f"Successfully added channel \2{params[0]}\2")
             await self.send_log('channel', f"Channel added by {source}: {params[0]}")
         elif command == 'delchan' and is_admin:
@@ -419,11 +813,13 @@ class FABot(irc.SASLIRCBot):
                 await self.send_notice(source, "Usage: delchan <channel>")
                 return
             channame = params[0].lower()
-            if channame not in self.data['channels']:
+            if channame not in self.state.channels:
                 await self.send_notice(source, "I'm not in that channel.")
                 return
-            self.data['channels'].pop(channame)
-            self._save_bot_data()
+            self.state.remove_channel(channame)
+            self.cancel_rejoin(channame)
+            self.work_queue.clear(channame)
+            self.e6_reply_history.drop(channame)
             await self.write_line(irc.IRCLine(verb='PART', params=[channame]))
             await self.send_notice(source, f"Successfully removed channel \2{params[0]}\2")
             await self.send_log('channel', f"Channel removed by {source}: {params[0]}")
@@ -431,12 +827,12 @@ class FABot(irc.SASLIRCBot):
             if len(params) != 0:
                 await self.send_notice(source, "Usage: listchans")
                 return
-            if len(self.data['channels']) == 1:
+            if len(self.state.channels) == 1:
                 await self.send_notice(source, "There is 1 channel.")
             else:
-                await self.send_notice(source, f"There are {len(self.data['channels'])} channels.")
+                await self.send_notice(source, f"There are {len(self.state.channels)} channels.")
             msg = ''
-            for channel in self.data['channels']:
+            for channel in self.state.channels:
                 if msg != '':
                     msg += ', '
                 msg += channel
@@ -463,7 +859,7 @@ class FABot(irc.SASLIRCBot):
             channel = params[1].lower()
             key = params[2].lower()
 
-            if channel not in self.data['channels']:
+            if channel not in self.state.channels:
                 await self.send_notice(source, "I'm not on that channel.")
                 return
 
@@ -471,8 +867,9 @@ class FABot(irc.SASLIRCBot):
                 if len(params) != 3:
                     await self.send_notice(source, "Usage: config get <channel> <key>")
                     return
-                if key in self.data['channels'][channel]:
-                    await self.send_notice(source, f"On {channel}: {key} = {self.data['channels'][channel][key]}")
+                value = self.state.get_channel_option(channel, key)
+                if value is not None:
+                    await self.send_notice(source, f"On {channel}: {key} = {value}")
                 else:
                     await self.send_notice(source, f"{key} is not set on {channel}.")
             elif op == 'set':
@@ -484,15 +881,11 @@ class FABot(irc.SASLIRCBot):
                     await self.send_notice(source, "Usage: config get <channel> <key> [value]")
                     return
 
+                self.state.set_channel_option(channel, key, value)
                 if value is None:
-                    if key in self.data['channels'][channel]:
-                        self.data['channels'][channel].pop(key)
-                    self._save_bot_data()
                     await self.send_notice(source, f"{key} has been unset on {channel}.")
                     await self.send_log('config', f"{line.sourceraw} has unset {key} on {channel}")
                 else:
-                    self.data['channels'][channel][key] = value
-                    self._save_bot_data()
                     await self.send_notice(source, f"{key} has been set to '{value}' on {channel}")
                     await self.send_log('config', f"{line.sourceraw} has set {key} to '{value}' on {channel}")
             else:
@@ -501,23 +894,59 @@ class FABot(irc.SASLIRCBot):
             if len(params) != 0:
                 await self.send_notice(source, "Usage: clearrecent")
                 return
-            self.fa_recent_lookups.clear()
+            self.fa_info.clear()
+            self.negative_lookups.clear()
             await self.send_log('FA', f"Recent lookups cleared (requested by {line.sourceraw})")
 
-            self.e6_recent_post_lookups.clear()
-            self.e6_recent_md5_lookups.clear()
-            self.e6_recent_search_pages.clear()
+            self.e6_search_sessions.clear()
+            self.e6_random_pools.clear()
+            self.e6_posts.clear()
             await self.send_log('E621', f"Recent post lookups and searches cleared (requested by {line.sourceraw})")
+        elif command == 'stats' and is_admin:
+            if len(params) != 0:
+                await self.send_notice(source, "Usage: stats")
+                return
+            await self.send_notice(source, self.get_stats())
+        elif command == 'profile' and is_admin:
+            if len(params) == 0 or params[0] not in ('start', 'stop') or len(params) > (2 if params[0] == 'start' else 1):
+                await self.send_notice(source, "Usage: profile <start [seconds]|stop>")
+                return
+
+            if params[0] == 'stop':
+                if not self.profile.active:
+                    await self.send_notice(source, "No profile is running.")
+                    return
+                await self.finish_profile(source)
+                return
+
+            if self.profile.active:
+                await self.send_notice(source, f"A profile started by {self.profile.owner} is already running.")
+                return
+            seconds = profiling.PROFILE_DEFAULT_SECS
+            if len(params) == 2:
+                if not params[1].isnumeric() or not 0 < int(params[1]) <= profiling.PROFILE_MAX_SECS:
+                    await self.send_notice(source, f"The profile length must be between 1 and {profiling.PROFILE_MAX_SECS} seconds.")
+                    return
+                seconds = int(params[1])
+
+            try:
+                self.profile.start(source)
+            except ValueError as ex:
+                await self.send_notice(source, f"Unable to start profiling: {ex}")
+                return
+            self.profile.timer = self.scheduler.call_later(seconds, self.finish_profile)
+            await self.send_notice(source, f"Profiling for {seconds} seconds.")
+            await self.send_log('profile', f"{line.sourceraw} started a {seconds} second profile")
         elif command == 'listoptout' and is_admin:
             if len(params) != 0:
                 await self.send_notice(source, "Usage: listoptout")
                 return
-            if len(self.data['optout']) == 1:
+            if len(self.state.optout) == 1:
                 await self.send_notice(source, "1 user has opted out.")
             else:
-                await self.send_notice(source, f"{len(self.data['optout'])} users have opted out.")
+                await self.send_notice(source, f"{len(self.state.optout)} users have opted out.")
             msg = ''
-            for optout in self.data['optout']:
+            for optout in sorted(self.state.optout):
                 if msg != '':
                     msg += ', '
                 msg += optout
@@ -534,11 +963,9 @@ class FABot(irc.SASLIRCBot):
                 await self.send_notice(source, "Please log in to NickServ so I know who you are.")
                 return
             accountname = line.tags['account']['value'].lower()
-            if accountname in self.data['optout']:
+            if not self.state.add_optout(accountname):
                 await self.send_notice(source, "You have already opted out of the service.")
                 return
-            self.data['optout'].append(accountname)
-            self._save_bot_data()
             await self.send_log('optout', f'\2{accountname}\2 has opted out of the service.')
             await self.send_notice(source, "You have opted out of the service.")
         elif command == 'optin':
@@ -549,11 +976,9 @@ class FABot(irc.SASLIRCBot):
                 await self.send_notice(source, "Please log in to NickServ so I know who you are.")
                 return
             accountname = line.tags['account']['value'].lower()
-            if accountname not in self.data['optout']:
+            if not self.state.remove_optout(accountname):
                 await self.send_notice(source, "You have not opted out of the service.")
                 return
-            self.data['optout'].remove(accountname)
-            self._save_bot_data()
             await self.send_log('optout', f'\2{accountname}\2 has opted back into the service.')
             await self.send_notice(source, "You have opted back into the service.")
         elif command == 'help':
@@ -568,8 +993,8 @@ class FABot(irc.SASLIRCBot):
         source = line.source['nick']
         target = line.params[0]
         targetchan = target.lower()
-        chandata = self.data['channels'][targetchan]
-        allow_nsfw = 'nsfw' in chandata and chandata['nsfw'] == 'true'
+        policy = self.state.channels[targetchan]
+        allow_nsfw = policy.allow_nsfw
 
         if command == 'e6md5':
             postsearch = None
@@ -602,11 +1027,11 @@ class FABot(irc.SASLIRCBot):
 
             suppressed_results = 0
             for post in posts:
-                if post['rating'] != 's' and not allow_nsfw:
+                if post.rating != 's' and not allow_nsfw:
                     suppressed_results += 1
                     continue
 
-                poststr = self.e621_create_poststr(post, include_post=True)
+                poststr = self.e621_create_poststr(post, include_post=True, blacklist=policy.blacklist)
                 self.add_e621_post_reply(targetchan, post)
                 await self.send_message(target, f"{source}: {poststr}")
 
@@ -624,21 +1049,19 @@ class FABot(irc.SASLIRCBot):
         elif command == 'random' or command == 'e6random' or command == 'rnd' or command == 'e6rnd':
             tags = ' '.join(params)
             await self.send_log('E621', f"Searching for random post with tags \2{tags}\2 (requested by {line.sourceraw} in {target})")
-            await self.e621_ratelimit_wait()
-
             try:
-                random_post = e6handler.search_post_random(self.__secrets['auth']['e621'], tags, not allow_nsfw)
+                random_post = await self.e621_random_post(tags, not allow_nsfw)
             except Exception as ex:
                 await self.send_log('E621', f"Random search failed for \2{tags}\2: Exception raised: {type(ex).__name__}: {str(ex)}")
                 await self.send_message(target, f"{source}: Error: An exception was raised while querying a random post.")
                 return
 
-            if 'error' in random_post:
+            if type(random_post) is dict and 'error' in random_post:
                 await self.send_log('E621', f"Random search failed for \2{tags}\2: {random_post['error']}")
                 await self.send_message(target, f"{source}: Error: {random_post['error']}")
                 return
 
-            poststr = self.e621_create_poststr(random_post, include_post=True)
+            poststr = self.e621_create_poststr(random_post, include_post=True, blacklist=policy.blacklist)
             await self.send_log('E621', f"Random search succeeded for \2{tags}\2: {poststr}")
             self.add_e621_post_reply(targetchan, random_post)
             await self.send_message(target, f"{source}: {poststr}")
@@ -665,35 +1088,32 @@ class FABot(irc.SASLIRCBot):
             pageidx = int(resnum / 100)
             residx = resnum % 100
 
-            if pageidx < 0 or pageidx >= 750:
-                await self.send_message(target, f"{source}: Invalid page number. The result must fall before page 751.")
+            session = self.e6_search_sessions.get(e6handler.normalize_query(tags), search_forcesafe or not allow_nsfw)
+            cursor = session.cursor_for(pageidx)
+            if pageidx < 0 or (pageidx >= SEARCH_MAX_NUMBERED_PAGE and cursor is None and session.get_page(pageidx) is None):
+                await self.send_message(target, f"{source}: Invalid page number. The result must fall before page {SEARCH_MAX_NUMBERED_PAGE + 1}, unless you step through the pages before it.")
                 return
 
             await self.send_log('E621', f"Searching for result \2{resnum}\2 of search \2{tags}\2 (requested by {line.sourceraw} in {target})")
 
-            now = time.time()
-            page_results = None
-            for lookup in self.e6_recent_search_pages:
-                if lookup[0] == tags and lookup[1] == pageidx and now - lookup[2] < 300:
-                    page_results = lookup[3]
-                    await self.send_log('E621', f"Found cached page: {len(page_results)} result(s) (requested by {line.sourceraw} in {target})")
-                    break
-
-            if page_results is None:
-                await self.e621_ratelimit_wait()
-                now = time.time()
+            page_results = count_cache_lookup('search_page', session.get_page, pageidx)
+            if page_results is not None:
+                await self.send_log('E621', f"Found cached page: {len(page_results)} result(s) (requested by {line.sourceraw} in {target})")
+            else:
                 try:
-                    page_results = e6handler.search_post_tags(self.__secrets['auth']['e621'], tags, search_forcesafe or not allow_nsfw, pageidx=pageidx)
+                    page_results = await self.fetch_search_page(session, pageidx, cursor)
                 except Exception as ex:
                     await self.send_log('E621', f"Search failed: Exception raised: {type(ex).__name__}: {str(ex)}")
                     await self.send_message(target, f"Error: An exception was raised while searching for the post.")
                     return
-                self.e6_recent_search_pages.append((tags, pageidx, now, page_results))
 
-            if 'error' in page_results:
-                await self.send_log('E621', f"Search failed: {page_results['error']}")
-                await self.send_message(target, f"Error: {page_results['error']}")
-                return
+                if type(page_results) is dict and 'error' in page_results:
+                    await self.send_log('E621', f"Search failed: {page_results['error']}")
+                    await self.send_message(target, f"Error: {page_results['error']}")
+                    return
+
+            if residx >= SEARCH_PREFETCH_AT:
+                self.prefetch_search_page(session, pageidx + 1)
 
             await self.send_log('E621', f"Search succeeded: {len(page_results)} result(s) found.")
             if residx >= len(page_results):
@@ -701,22 +1121,21 @@ class FABot(irc.SASLIRCBot):
                 return
 
             post = page_results[residx]
-            poststr = self.e621_create_poststr(post, include_post=True)
+            poststr = self.e621_create_poststr(post, include_post=True, blacklist=policy.blacklist)
             self.add_e621_post_reply(targetchan, post)
             await self.send_message(target, f"{source}: {poststr}")
         elif command == 'e6tags':
             if len(params) == 1 and params[0] == '+':
-                if targetchan not in self.e6_tag_more:
+                more = self.e6_reply_history.get_tag_more(targetchan)
+                if more is None:
                     await self.send_message(target, f"{source}: There are no more tags to display.")
                     return
 
-                more = self.e6_tag_more[targetchan]
-                if len(more[0]) == 0:
+                post_id, page = more
+                post = await self.get_e621_post(post_id, targetchan, line.sourceraw)
+                if not post or page >= len(post.get_tag_pages()):
                     await self.send_message(target, f"{source}: There are no more tags to display.")
                     return
-
-                tag_list = more[0]
-                post_id = more[1]
                 more = True
             else:
                 histidx = 1
@@ -735,28 +1154,19 @@ class FABot(irc.SASLIRCBot):
 
                 histidx -= 1  # convert to 0-based index
 
-                post = None
-                if targetchan in self.e6_recent_post_replies:
-                    recents = self.e6_recent_post_replies[targetchan]
-                    if len(recents) > histidx:
-                        post = recents[histidx]
-
+                post = await self.get_e621_post_reply(targetchan, histidx, line.sourceraw)
                 if not post:
                     await self.send_message(target, f"{source}: I don't remember that many recent posts.")
                     return
 
-                tags = set()
-                for key in post['tags']:
-                    for tag in post['tags'][key]:
-                        tags.add(tag)
-                tag_list = sorted(tags)
-                post_id = post['id']
+                post_id = post.id
+                page = 0
                 more = False
 
-            tagstr, extrastr, leftover = get_tagstr(tag_list)
+            tagstr, extrastr, has_more = get_tagstr(post, page)
 
             await self.send_message(target, f"{source}: [E621/{post_id}{'+' if more else ''}] {tagstr}{extrastr}")
-            self.e6_tag_more[targetchan] = (leftover, post_id)
+            self.e6_reply_history.set_tag_more(targetchan, (post_id, page + 1) if has_more else None)
         elif command == 'help':
             if len(params) != 0:
                 await self.send_message(target, f"{source}: Usage: help")
@@ -775,11 +1185,9 @@ class FABot(irc.SASLIRCBot):
                 await self.send_notice(source, "Usage: admin add <accountname>")
                 return
             adminname = params[1].lower()
-            if adminname in self.data['admins']:
+            if not self.state.add_admin(adminname):
                 await self.send_notice(source, "That account is already an administrator.")
                 return
-            self.data['admins'].append(adminname)
-            self._save_bot_data()
             await self.send_notice(source, f"\2{params[1]}\2 is now an administrator.")
             await self.send_log('admin', f"Administrator added by {source}: {params[1]}")
         elif subcmd == 'remove':
@@ -787,23 +1195,21 @@ class FABot(irc.SASLIRCBot):
                 await self.send_notice(source, "Usage: admin remove <accountname>")
                 return
             adminname = params[1].lower()
-            if adminname not in self.data['admins']:
+            if not self.state.remove_admin(adminname):
                 await self.send_notice(source, "That account is not an administrator.")
                 return
-            self.data['admins'].remove(adminname)
-            self._save_bot_data()
             await self.send_notice(source, f"\2{params[1]}\2 is now no longer an administrator.")
             await self.send_log('admin', f"Administrator removed by {source}: {params[1]}")
         elif subcmd == 'list':
             if len(params) != 1:
                 await self.send_notice(source, "Usage: admin list")
                 return
-            if len(self.data['admins']) == 1:
+            if len(self.state.admins) == 1:
                 await self.send_notice(source, "There is 1 administrator.")
             else:
-                await self.send_notice(source, f"There are {len(self.data['admins'])} administrators.")
+                await self.send_notice(source, f"There are {len(self.state.admins)} administrators.")
             msg = ''
-            for admin in self.data['admins']:
+            for admin in sorted(self.state.admins):
                 if msg != '':
                     msg += ', '
                 msg += admin
@@ -0,0 +1,370 @@
+import collections
+import time
+
+import e6handler
+import metrics
+
+POST_CACHE_SIZE = 500
+POST_SOFT_TTL_SECS = 300
+POST_HARD_TTL_SECS = 60 * 60
+FA_INFO_CACHE_SIZE = 200
+REPLY_HISTORY_PER_CHANNEL = 20
+REPLY_HISTORY_MAX_TOTAL = 2000
+REPLY_HISTORY_IDLE_SECS = 6 * 60 * 60
+SEARCH_SESSIONS = 20
+SEARCH_PAGE_TTL_SECS = 300
+SEARCH_PAGE_KEEP_SECS = 30 * 60
+SEARCH_PAGE_SIZE = 100
+RANDOM_POOLS = 50
+RANDOM_POOL_SIZE = 20
+RANDOM_POOL_TTL_SECS = 600
+RANDOM_POOL_WATERMARK = 5
+NEGATIVE_CACHE_SIZE = 500
+NEGATIVE_TTL_SECS = {'notfound': 600, 'transient': 15}
+
+NEGATIVE_LOOKUPS = metrics.counter('negative_cache_lookups_total', "Failed lookups served from the negative cache (hit) or from upstream (miss), by error kind", ('kind', 'result'))
+
+
+# Posts by id and md5. Past the soft TTL they're refreshed, past the hard TTL treated as missing.
+class PostCache:
+    def __init__(self, capacity=POST_CACHE_SIZE, soft_ttl=POST_SOFT_TTL_SECS, hard_ttl=POST_HARD_TTL_SECS):
+        self.capacity = capacity
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+        self._posts = collections.OrderedDict()
+        self._md5_index = {}
+
+    def __len__(self):
+        return len(self._posts)
+
+    def _is_fresh(self, post, now):
+        return (time.time() if now is None else now) - post.fetched < self.hard_ttl
+
+    def is_stale(self, post, now=None):
+        return (time.time() if now is None else now) - post.fetched >= self.soft_ttl
+
+    def get(self, post_id):
+        post = self._posts.get(post_id)
+        if post is not None:
+            self._posts.move_to_end(post_id)
+        return post
+
+    def get_fresh(self, post_id, now=None):
+        post = self.get(post_id)
+        return post if post is not None and self._is_fresh(post, now) else None
+
+    def get_fresh_md5(self, md5_hash, now=None):
+        post_id = self._md5_index.get(md5_hash.lower())
+        return self.get_fresh(post_id, now) if post_id is not None else None
+
+    def add(self, post):
+        old = self._posts.get(post.id)
+        if old is not None and old.md5 != post.md5:
+            self._md5_index.pop(old.md5, None)
+        self._posts[post.id] = post
+        self._posts.move_to_end(post.id)
+        if post.md5 is not None:
+            self._md5_index[post.md5] = post.id
+
+        while len(self._posts) > self.capacity:
+            _, evicted = self._posts.popitem(last=False)
+            if self._md5_index.get(evicted.md5) == evicted.id:
+                del self._md5_index[evicted.md5]
+
+    # Takes any e6handler result: a post, a list of posts or an error
+    def add_result(self, result):
+        if isinstance(result, e6handler.E621Post):
+            self.add(result)
+        elif type(result) is list:
+            for post in result:
+                self.add(post)
+
+    def discard(self, post_id):
+        post = self._posts.pop(post_id, None)
+        if post is not None and self._md5_index.get(post.md5) == post_id:
+            del self._md5_index[post.md5]
+
+    def clear(self):
+        self._posts.clear()
+        self._md5_index.clear()
+
+
+class LookupCache:
+    def __init__(self, capacity=FA_INFO_CACHE_SIZE, soft_ttl=POST_SOFT_TTL_SECS, hard_ttl=POST_HARD_TTL_SECS):
+        self.capacity = capacity
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_fresh(self, key, now=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if (time.time() if now is None else now) - entry[0] >= self.hard_ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def is_stale(self, key, now=None):
+        entry = self._entries.get(key)
+        return entry is None or (time.time() if now is None else now) - entry[0] >= self.soft_ttl
+
+    def put(self, key, value, now=None):
+        self._entries[key] = (time.time() if now is None else now, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+# Failed lookups, kept for a TTL that depends on the error kind
+class NegativeCache:
+    def __init__(self, ttls=NEGATIVE_TTL_SECS, capacity=NEGATIVE_CACHE_SIZE):
+        self.ttls = ttls
+        self.capacity = capacity
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, now=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if (time.time() if now is None else now) >= entry[0]:
+            del self._entries[key]
+            return None
+        NEGATIVE_LOOKUPS.inc(entry[1], 'hit')
+        return entry[2]
+
+    def add(self, key, kind, value, now=None):
+        NEGATIVE_LOOKUPS.inc(kind, 'miss')
+        ttl = self.ttls.get(kind)
+        if ttl is None:
+            return
+        self._entries[key] = ((time.time() if now is None else now) + ttl, kind, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def add_error(self, key, error, now=None):
+        self.add(key, error.get('kind', 'error'), error, now)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class ChannelHistory:
+    __slots__ = ('post_ids', 'last_active', 'tag_more')
+
+    def __init__(self, maxlen):
+        self.post_ids = collections.deque(maxlen=maxlen)
+        self.last_active = time.time()
+        self.tag_more = None
+
+
+class ReplyHistory:
+    def __init__(self, per_channel=REPLY_HISTORY_PER_CHANNEL, max_total=REPLY_HISTORY_MAX_TOTAL, idle_secs=REPLY_HISTORY_IDLE_SECS):
+        self.per_channel = per_channel
+        self.max_total = max_total
+        self.idle_secs = idle_secs
+        self._channels = collections.OrderedDict()
+        self._total = 0
+
+    def _touch(self, chan):
+        history = self._channels.get(chan)
+        if history is None:
+            history = ChannelHistory(self.per_channel)
+            self._channels[chan] = history
+        else:
+            self._channels.move_to_end(chan)
+        history.last_active = time.time()
+        return history
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+        while self._channels:
+            chan, history = next(iter(self._channels.items()))
+            if now - history.last_active < self.idle_secs:
+                break
+            self.drop(chan)
+
+    def add(self, chan, post_id):
+        self.expire()
+        history = self._touch(chan)
+        if len(history.post_ids) == history.post_ids.maxlen:
+            self._total -= 1
+        history.post_ids.appendleft(post_id)
+        self._total += 1
+
+        while self._total > self.max_total:
+            oldest_chan, oldest = next(iter(self._channels.items()))
+            oldest.post_ids.pop()
+            self._total -= 1
+            if not oldest.post_ids:
+                self.drop(oldest_chan)
+
+    def get(self, chan, idx):
+        history = self._channels.get(chan)
+        if history is None or idx >= len(history.post_ids):
+            return None
+        return history.post_ids[idx]
+
+    def get_tag_more(self, chan):
+        history = self._channels.get(chan)
+        return history.tag_more if history is not None else None
+
+    def set_tag_more(self, chan, tag_more):
+        self._touch(chan).tag_more = tag_more
+
+    def drop(self, chan):
+        history = self._channels.pop(chan, None)
+        if history is not None:
+            self._total -= len(history.post_ids)
+
+    def clear(self):
+        self._channels.clear()
+        self._total = 0
+
+
+def query_key(query, sfw):
+    return e6handler.get_site(sfw), query
+
+
+class SearchSession:
+    __slots__ = ('query', 'sfw', 'ordered', 'pages', 'prefetching')
+
+    def __init__(self, query, sfw):
+        self.query = query
+        self.sfw = sfw
+        self.ordered = e6handler.is_ordered_query(query)
+        self.pages = {}
+        self.prefetching = set()
+
+    def get_page(self, pageidx, now=None, max_age=SEARCH_PAGE_TTL_SECS):
+        entry = self.pages.get(pageidx)
+        if entry is None or (time.time() if now is None else now) - entry[0] >= max_age:
+            return None
+        return entry[1]
+
+    def put_page(self, pageidx, posts, validators=None, now=None):
+        self.pages[pageidx] = (time.time() if now is None else now, posts, validators)
+
+    # Expired pages are kept so they can be revalidated
+    def get_validators(self, pageidx):
+        entry = self.pages.get(pageidx)
+        return dict(entry[2]) if entry is not None and entry[2] else {}
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+        for pageidx, entry in list(self.pages.items()):
+            if now - entry[0] >= SEARCH_PAGE_KEEP_SECS:
+                del self.pages[pageidx]
+
+    # A b<id> cursor is only the next page in the default (newest first) order
+    def cursor_for(self, pageidx):
+        if self.ordered or pageidx == 0:
+            return None
+        prev = self.get_page(pageidx - 1)
+        if not prev or len(prev) < SEARCH_PAGE_SIZE:
+            return None
+        return f"b{prev[-1].id}"
+
+    def has_next_page(self, pageidx):
+        page = self.get_page(pageidx)
+        return page is not None and len(page) >= SEARCH_PAGE_SIZE
+
+
+class SearchSessionCache:
+    def __init__(self, capacity=SEARCH_SESSIONS):
+        self.capacity = capacity
+        self._sessions = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, query, sfw):
+        key = query_key(query, sfw)
+        session = self._sessions.get(key)
+        if session is None:
+            session = SearchSession(query, sfw)
+            self._sessions[key] = session
+            while len(self._sessions) > self.capacity:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(key)
+        return session
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+        for key, session in list(self._sessions.items()):
+            session.expire(now)
+            if not session.pages and not session.prefetching:
+                del self._sessions[key]
+
+    def clear(self):
+        self._sessions.clear()
+
+
+class RandomPool:
+    __slots__ = ('query', 'sfw', 'posts', 'fetched', 'refilling')
+
+    def __init__(self, query, sfw):
+        self.query = query
+        self.sfw = sfw
+        self.posts = collections.deque()
+        self.fetched = 0
+        self.refilling = False
+
+    def fill(self, posts, now=None):
+        self.posts.clear()
+        self.posts.extend(posts)
+        self.fetched = time.time() if now is None else now
+
+
+class RandomPoolCache:
+    def __init__(self, size=RANDOM_POOL_SIZE, ttl=RANDOM_POOL_TTL_SECS, watermark=RANDOM_POOL_WATERMARK, capacity=RANDOM_POOLS):
+        self.size = size
+        self.ttl = ttl
+        self.watermark = watermark
+        self.capacity = capacity
+        self._pools = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._pools)
+
+    def get(self, query, sfw, now=None):
+        key = query_key(query, sfw)
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = RandomPool(query, sfw)
+            self._pools[key] = pool
+            while len(self._pools) > self.capacity:
+                self._pools.popitem(last=False)
+        else:
+            self._pools.move_to_end(key)
+
+        if (time.time() if now is None else now) - pool.fetched >= self.ttl:
+            pool.posts.clear()
+        return pool
+
+    def needs_refill(self, pool):
+        return not pool.refilling and len(pool.posts) < self.watermark
+
+    def clear(self):
+        self._pools.clear()
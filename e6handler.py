@@ -1,9 +1,21 @@
 import json
 import re
+import sys
+import threading
+import time
 import requests
 import requests.auth
 import urllib.parse
 import traceback
+import weakref
+
+import tracing
+import upstream
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 E621_POST_PATTERN = re.compile("e(?:621|926)\\.net/(?:posts|post/show)/(\\d+)", re.IGNORECASE)
 E621_IMAGE_PATTERN = re.compile("static1\\.e(?:621|926)\\.net/data/(preview/|sample/)?[\\da-f]{2}/[\\da-f]{2}/([\\da-f]+)\\.[a-z]+", re.IGNORECASE)
@@ -18,6 +30,10 @@ BLACKLIST_GENERAL = ['rape']
 BLACKLIST_GENERAL_POST = ['bestiality']
 CONTENT_WARNING_GENERAL = ['scat', 'watersports', 'vore', 'gore', 'what_has_science_done', 'where_is_your_god_now', 'pregnant']
 BLACKLIST_SEARCHSTR = ''
+TAG_PAGE_LENGTH = 350
+ORDER_DEPENDENT_METATAGS = ('order', 'randseed')
+CASE_SENSITIVE_METATAGS = ('source', 'description', 'note', 'delreason')
+NOT_MODIFIED = object()
 
 
 def get_rating(key):
@@ -27,77 +43,239 @@ def get_rating(key):
         return f"Unknown ({key})"
 
 
+class E621Post:
+    __slots__ = ('id', 'rating', 'tags', 'score_up', 'score_down', 'score_total', 'deleted', 'flagged',
+                 'has_file', 'file_width', 'file_height', 'file_url', 'md5', 'fetched', 'validators', '_tag_list',
+                 '_tag_pages', '__weakref__')
+
+    def __init__(self, post_id):
+        self.id = post_id
+        self.validators = None
+        self._tag_list = None
+        self._tag_pages = None
+
+    def update(self, obj):
+        self.rating = sys.intern(obj['rating'])
+        self.tags = {sys.intern(category): tuple(sys.intern(tag) for tag in tags) for category, tags in obj['tags'].items()}
+
+        score = obj['score']
+        self.score_up = score['up']
+        self.score_down = score['down']
+        self.score_total = score['total']
+
+        flags = obj['flags']
+        self.deleted = bool(flags['deleted'])
+        self.flagged = bool(flags['flagged'])
+
+        self.has_file = 'file' in obj
+        file_obj = obj.get('file') or {}
+        self.file_width = file_obj.get('width')
+        self.file_height = file_obj.get('height')
+        self.file_url = file_obj.get('url')
+        self.md5 = file_obj.get('md5')
+        self.fetched = time.time()
+
+        self._tag_list = None
+        self._tag_pages = None
+
+    def get_tag_list(self):
+        if self._tag_list is None:
+            self._tag_list = tuple(sorted({tag for tags in self.tags.values() for tag in tags}))
+        return self._tag_list
+
+    # End index of each TAG_PAGE_LENGTH page of the sorted tag list
+    def get_tag_pages(self):
+        if self._tag_pages is None:
+            tag_list = self.get_tag_list()
+            pages = []
+            length = -2
+            for idx, tag in enumerate(tag_list):
+                length += 2 + len(tag)
+                if length > TAG_PAGE_LENGTH:
+                    pages.append(idx + 1)
+                    length = -2
+            if not pages or pages[-1] != len(tag_list):
+                pages.append(len(tag_list))
+            self._tag_pages = tuple(pages)
+        return self._tag_pages
+
+
+_post_records = weakref.WeakValueDictionary()
+_post_records_lock = threading.Lock()  # requests are made from executor threads
+
+
+# The API always sends UTF-8, so requests' charset detection is skipped
+@tracing.traced('decode')
+def decode_json(response):
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return json.loads(response.content)
+
+
+# Each raw post is dropped once compacted, so the raw page and the records aren't both held
+@tracing.traced('project')
+def compact_posts(objs):
+    objs.reverse()
+    posts = []
+    while objs:
+        posts.append(compact_post(objs.pop()))
+    return posts
+
+
+def compact_post(obj):
+    post_id = obj['id']
+    with _post_records_lock:
+        post = _post_records.get(post_id)
+        if post is None:
+            post = E621Post(post_id)
+            _post_records[post_id] = post
+        post.update(obj)
+    return post
+
+
+# Cache key for a query: plain tags lowercased and sorted, order-dependent and free-text metatags kept as given
+def normalize_query(tags: str):
+    if '"' in tags:
+        return ' '.join(tags.split())
+
+    seen = set()
+    plain = []
+    ordered = []
+    for tag in tags.split():
+        name, sep, value = tag.partition(':')
+        metatag = name.lower().lstrip('-~')
+        if sep and metatag in CASE_SENSITIVE_METATAGS:
+            tag = name.lower() + sep + value
+        else:
+            tag = tag.lower()
+
+        if tag in seen:
+            continue
+        seen.add(tag)
+        if sep and metatag in ORDER_DEPENDENT_METATAGS:
+            ordered.append(tag)
+        else:
+            plain.append(tag)
+    return ' '.join(sorted(plain) + ordered)
+
+
+def is_ordered_query(query: str):
+    return any(tag.lstrip('-').startswith('order:') for tag in query.split())
+
+
+def get_site(sfw: bool):
+    return 'e926' if sfw else 'e621'
+
+
+def status_error(response):
+    return {'error': f"Server responded with {response.status_code} {response.reason}", 'kind': upstream.get_error_kind(response.status_code)}
+
+
+def get_request_headers(validators=None):
+    headers = {'User-Agent': USER_AGENT}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def get_validators(response):
+    return {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+
+def api_get(secrets, url, validators=None):
+    with upstream.UPSTREAM_SECONDS.time('e621'), tracing.span('http', service='e621'):
+        response = requests.get(url,
+                                headers=get_request_headers(validators),
+                                auth=requests.auth.HTTPBasicAuth(secrets['username'], secrets['api_key']))
+    upstream.UPSTREAM_RESPONSES.inc('e621', str(response.status_code))
+    return response
+
+
 def get_post_info(secrets, post_id):
+    with _post_records_lock:
+        cached = _post_records.get(int(post_id)) if post_id.isdigit() else None
+
     post_url = f"https://e621.net/posts/{urllib.parse.quote(post_id, safe='', encoding='utf-8', errors='replace')}.json"
-    response = requests.get(post_url,
-                            headers={'User-Agent': USER_AGENT},
-                            auth=requests.auth.HTTPBasicAuth(secrets['username'], secrets['api_key']))
-    if response.status_code == 404:
-        return {'error': "Post not found"}
+    response = api_get(secrets, post_url, cached.validators if cached is not None else None)
+    if response.status_code == 304 and cached is not None:
+        cached.fetched = time.time()
+        return cached
+    elif response.status_code == 404:
+        return {'error': "Post not found", 'kind': 'notfound'}
     elif response.status_code != 200:
-        return {'error': f"Server responded with {response.status_code} {response.reason}"}
+        return status_error(response)
 
     try:
-        return response.json()['post']
+        post = compact_post(decode_json(response)['post'])
+        post.validators = get_validators(response)
+        return post
     except json.JSONDecodeError as ex:
         traceback.print_exception(type(ex), ex, ex.__traceback__)
-        return {'error': "Unable to decode response from server (please contact the bot owner immediately)"}
+        return {'error': "Unable to decode response from server (please contact the bot owner immediately)", 'kind': 'transient'}
 
 
 def search_post_hash(secrets, md5_hash):
     search_url = f"https://e621.net/posts.json?tags={urllib.parse.quote_plus(f'md5:{md5_hash} status:any', safe='', encoding='utf-8', errors='replace')}"
-    response = requests.get(search_url,
-                            headers={'User-Agent': USER_AGENT},
-                            auth=requests.auth.HTTPBasicAuth(secrets['username'], secrets['api_key']))
+    response = api_get(secrets, search_url)
     if response.status_code != 200:
-        return {'error': f"Server responded with {response.status_code} {response.reason}"}
+        return status_error(response)
 
     try:
-        return response.json()['posts']
+        return compact_posts(decode_json(response)['posts'])
     except json.JSONDecodeError as ex:
         traceback.print_exception(type(ex), ex, ex.__traceback__)
-        return {'error': "Unable to decode response from server (please contact the bot owner immediately)"}
+        return {'error': "Unable to decode response from server (please contact the bot owner immediately)", 'kind': 'transient'}
 
 
 def search_post_random(secrets, tags: str, sfw: bool):
-    search_url = f"https://{'e926' if sfw else 'e621'}.net/posts/random.json?tags={urllib.parse.quote_plus(BLACKLIST_SEARCHSTR + ' ' + tags, safe='', encoding='utf-8', errors='replace')}"
-    response = requests.get(search_url,
-                            headers={'User-Agent': USER_AGENT},
-                            auth=requests.auth.HTTPBasicAuth(secrets['username'], secrets['api_key']))
+    search_url = f"https://{get_site(sfw)}.net/posts/random.json?tags={urllib.parse.quote_plus(BLACKLIST_SEARCHSTR + ' ' + tags, safe='', encoding='utf-8', errors='replace')}"
+    response = api_get(secrets, search_url)
     if response.status_code == 404:
-        return {'error': f"No posts were found by those tags"}
+        return {'error': f"No posts were found by those tags", 'kind': 'notfound'}
     elif response.status_code != 200:
-        return {'error': f"Server responded with {response.status_code} {response.reason}"}
+        return status_error(response)
 
     try:
-        res = response.json()
+        res = decode_json(response)
     except json.JSONDecodeError as ex:
         traceback.print_exception(type(ex), ex, ex.__traceback__)
-        return {'error': "Unable to decode response from server (please contact the bot owner immediately)"}
+        return {'error': "Unable to decode response from server (please contact the bot owner immediately)", 'kind': 'transient'}
 
     if 'success' in res and not res['success']:
-        return {'error': f"Request unsuccessful: {res['reason']}"}
-    return res['post']
+        return {'error': f"Request unsuccessful: {res['reason']}", 'kind': 'error'}
+    return compact_post(res['post'])
 
 
-def search_post_tags(secrets, tags: str, sfw: bool, pageidx=0):
-    search_url = f"https://{'e926' if sfw else 'e621'}.net/posts.json?tags={urllib.parse.quote_plus(BLACKLIST_SEARCHSTR + ' ' + tags, safe='', encoding='utf-8', errors='replace')}&limit=100&page={pageidx + 1}"
-    response = requests.get(search_url,
-                            headers={'User-Agent': USER_AGENT},
-                            auth=requests.auth.HTTPBasicAuth(secrets['username'], secrets['api_key']))
-    if response.status_code != 200:
-        return {'error': f"Server responded with {response.status_code} {response.reason}"}
+# page is a 1-based page number or a b<id> cursor; validators makes it a conditional request
+def search_post_tags(secrets, tags: str, sfw: bool, page=1, limit=100, validators=None):
+    search_url = f"https://{get_site(sfw)}.net/posts.json?tags={urllib.parse.quote_plus(BLACKLIST_SEARCHSTR + ' ' + tags, safe='', encoding='utf-8', errors='replace')}&limit={limit}&page={page}"
+    response = api_get(secrets, search_url, validators)
+    if response.status_code == 304 and validators:
+        return NOT_MODIFIED
+    elif response.status_code != 200:
+        return status_error(response)
 
     try:
-        res = response.json()
+        res = decode_json(response)
     except json.JSONDecodeError as ex:
         traceback.print_exception(type(ex), ex, ex.__traceback__)
-        return {'error': "Unable to decode response from server (please contact the bot owner immediately)"}
+        return {'error': "Unable to decode response from server (please contact the bot owner immediately)", 'kind': 'transient'}
 
     if 'success' in res and not res['success']:
-        return {'error': f"Request unsuccessful: {res['reason']}"}
-    return res['posts']
+        return {'error': f"Request unsuccessful: {res['reason']}", 'kind': 'error'}
+    if validators is not None:
+        validators.update(get_validators(response))
+    return compact_posts(res['posts'])
+
+
+def search_post_random_batch(secrets, tags: str, sfw: bool, limit: int):
+    return search_post_tags(secrets, f"{tags} order:random", sfw, limit=limit)
+
 
+BLACKLIST_POST = frozenset(BLACKLIST_GENERAL + BLACKLIST_GENERAL_POST)
 
 for item in BLACKLIST_GENERAL:
     if BLACKLIST_SEARCHSTR != '':
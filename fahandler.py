@@ -1,35 +1,55 @@
-import cfscrape
 import bs4
 import re
+import threading
+import tracing
+import upstream
 import urllib.parse
 
 FURAFFINITY_POST_PATTERN = re.compile("furaffinity\\.net/(?:view|full)/(\\d+)", re.IGNORECASE)
 
-scraper = cfscrape.create_scraper()
+scraper = None
+scraper_lock = threading.Lock()  # the scraper session and its cookies are shared by every lookup
+
+
+# Created on first use so parse_info works without cfscrape; call with scraper_lock held
+def get_scraper():
+    global scraper
+    if scraper is None:
+        import cfscrape
+        scraper = cfscrape.create_scraper()
+    return scraper
+
 
 # Code adapted from https://github.com/Hidoni/FAToFACDN/blob/master/furaffinityhandler.py
 
 
 def get_info(secrets, post_id):
     myusername = secrets['username']
-    scraper.get("https://www.furaffinity.net/")
-    scraper.cookies.update(secrets['cookies'])
     post_url = f'https://www.furaffinity.net/view/{urllib.parse.quote(post_id, safe="", encoding="utf-8", errors="replace")}/'
-    response = scraper.get(post_url)
+    with scraper_lock, upstream.UPSTREAM_SECONDS.time('furaffinity'), tracing.span('http', service='furaffinity'):
+        session = get_scraper()
+        session.get("https://www.furaffinity.net/")
+        session.cookies.update(secrets['cookies'])
+        response = session.get(post_url)
+    upstream.UPSTREAM_RESPONSES.inc('furaffinity', str(response.status_code))
     if response.status_code == 404:
-        return {'error': "Post not found"}
+        return {'error': "Post not found", 'kind': 'notfound'}
     elif response.status_code != 200:
-        return {'error': f"Server responded with {response.status_code} {response.reason}"}
+        return {'error': f"Server responded with {response.status_code} {response.reason}", 'kind': upstream.get_error_kind(response.status_code)}
+
+    return parse_info(response.content, post_url, myusername)
+
 
-    content = response.content
-    soup = bs4.BeautifulSoup(content, 'html.parser')
+def parse_info(content, post_url, myusername=None):
+    with tracing.span('parse_html'):
+        soup = bs4.BeautifulSoup(content, 'html.parser')
 
     info = {}
 
     if soup.title.get_text() == 'System Error':
-        return {'error': "Post not found"}
+        return {'error': "Post not found", 'kind': 'notfound'}
     if soup.find('div', class_="audio-player-container") or soup.find('div', class_="font-size-panel"):
-        return {'error': "URL points to an audio or story post"}
+        return {'error': "URL points to an audio or story post", 'kind': 'notfound'}
 
     if myusername:
         found = False
@@ -38,7 +58,7 @@ def get_info(secrets, post_id):
                 found = True
                 break
         if not found:
-            return {'error': "Not logged in (invalid cookies?)"}
+            return {'error': "Not logged in (invalid cookies?)", 'kind': 'auth'}
 
     submit_img = soup.find('img', id='submissionImg')
     if submit_img is not None and submit_img.has_attr('data-fullview-src'):
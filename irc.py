@@ -5,6 +5,10 @@ import base64
 import random
 import traceback
 
+import metrics
+import scheduler
+import tracing
+
 
 class ParseError(BaseException):
     def __init__(self, desc, line, cursor):
@@ -60,6 +64,7 @@ class IRCLine:
         self.sourceraw = source
         self.verb = verb
         self.params = params
+        self.trace_id = None
 
     def _parse_error(self, desc):
         return ParseError(desc, self.line, self._cursor)
@@ -280,9 +285,22 @@ class IRCLine:
         return ret
 
 
+MAX_LINE_BYTES = 512
 PING_FREQ_SECS = 30
 PING_TIMEOUT_SECS = 60
 SEEK_NICK_CHECK_FREQ = 20
+RECONNECT_MIN_SECS = 2
+RECONNECT_MAX_SECS = 300
+RECONNECT_STABLE_SECS = 60
+REGISTER_TIMEOUT_SECS = 60
+CAP_TIMEOUT_SECS = 10
+SASL_TIMEOUT_SECS = 15
+
+
+IRC_LINES = metrics.counter('irc_lines_total', "IRC lines received and sent", ('direction', 'verb'), always_on=True)
+IRC_PARSE_SECONDS = metrics.histogram('irc_parse_seconds', "Time spent parsing received IRC lines")
+IRC_HANDLER_SECONDS = metrics.histogram('irc_handler_seconds', "Time spent handling received IRC lines", ('verb',))
+IRC_WRITE_BUFFER = metrics.gauge('irc_write_buffer_bytes', "Bytes waiting in the outbound socket buffer")
 
 
 # TODO: does not handle casemapping AT ALL (assumes ascii)
@@ -302,19 +320,41 @@ class IRCBot:
         self._ping_key = None
 
         self._seek_nick = nick
-        self._seek_nick_check = time.time()
+
+        self.scheduler = scheduler.Scheduler()
+        self._connection_timers = []
+        self._ping_timer = None
+
+        self._connect_started = None
+        self.timings = {}
 
         self.pending_responses = {}
+        IRC_WRITE_BUFFER.set_function(self.write_buffer_size)
+
+    def write_buffer_size(self):
+        if self._writer is None:
+            return 0
+        return self._writer.transport.get_write_buffer_size()
 
     async def handle_raw_line(self, recv):
+        with tracing.start_trace('line') as trace:
+            await self._handle_raw_line(recv, trace)
+
+    async def _handle_raw_line(self, recv, trace):
         line = IRCLine(recv)
         try:
-            line.parse()
+            with IRC_PARSE_SECONDS.time(), tracing.span('parse'):
+                line.parse()
             print(f" IN: {line}")
+            IRC_LINES.inc('in', line.verb.upper())
+            if trace is not None:
+                trace.name = line.verb.upper()
+                line.trace_id = trace.trace_id
 
             try:
                 method = getattr(self, "handle_verb_" + line.verb.lower())
-                await method(line)
+                with IRC_HANDLER_SECONDS.time(line.verb.upper()), tracing.span('handle', verb=line.verb.upper()):
+                    await method(line)
             except AttributeError:
                 await self.handle_unknown_verb(line)
             except BaseException as ex:
@@ -330,13 +370,35 @@ class IRCBot:
         pass
 
     async def write_line(self, line: IRCLine):
+        if self._writer is None or self._writer.is_closing():
+            print(f"OUT (not connected, dropped): {line}")
+            return
         print(f"OUT: {line}")
-        self._writer.write((str(line) + "\r\n").encode('utf-8', errors='replace'))
+        IRC_LINES.inc('out', line.verb.upper())
+        with tracing.span('send', verb=line.verb.upper()):
+            self._writer.write((str(line) + "\r\n").encode('utf-8', errors='replace'))
+            await self._writer.drain()
+
+    async def write_lines(self, lines):
+        if self._writer is None or self._writer.is_closing():
+            for line in lines:
+                print(f"OUT (not connected, dropped): {line}")
+            return
+        for line in lines:
+            print(f"OUT: {line}")
+            IRC_LINES.inc('out', line.verb.upper())
+            self._writer.write((str(line) + "\r\n").encode('utf-8', errors='replace'))
         await self._writer.drain()
 
     async def on_connect(self):
+        self._connection_timers.append(self.scheduler.call_later(REGISTER_TIMEOUT_SECS, self._check_register_timeout))
         await self.register()
 
+    async def _check_register_timeout(self):
+        if not self.registered:
+            print(f"Registration did not complete in {REGISTER_TIMEOUT_SECS} seconds, disconnecting")
+            self.disconnect(abort=True)
+
     async def quit(self, message: str):
         await self.write_line(IRCLine(verb="QUIT", params=[message]))
 
@@ -345,33 +407,90 @@ class IRCBot:
         if key is not None: params.append(key)
         await self.write_line(IRCLine(verb='JOIN', params=params))
 
-    def shutdown(self):
+    # Keyed channels go first, since keys are matched to channels by position
+    async def join_many(self, channels):
+        ordered = [c for c in channels if c[1] is not None] + [c for c in channels if c[1] is None]
+        names, keys = [], []
+        length = 0
+        for channel, key in ordered:
+            name_bytes = len(channel.encode('utf-8', errors='replace')) + 1
+            key_bytes = len(key.encode('utf-8', errors='replace')) + 1 if key is not None else 0
+            if names and len('JOIN \r\n') + length + name_bytes + key_bytes > MAX_LINE_BYTES:
+                await self._write_join(names, keys)
+                names, keys = [], []
+                length = 0
+            names.append(channel)
+            if key is not None:
+                keys.append(key)
+            length += name_bytes + key_bytes
+
+        if names:
+            await self._write_join(names, keys)
+
+    async def _write_join(self, names, keys):
+        params = [','.join(names)]
+        if keys: params.append(','.join(keys))
+        await self.write_line(IRCLine(verb='JOIN', params=params))
+
+    def disconnect(self, abort=False):
+        if self._writer is not None:
+            if abort:
+                self._writer.transport.abort()
+            else:
+                self._writer.close()
+
+    def shutdown(self, abort=False):
         self._shutdown = True
+        self.disconnect(abort)
+
+    def registration_lines(self):
+        return [IRCLine(verb="NICK", params=[self.nick]), IRCLine(verb="USER", params=[self.ident, '0', '*', self.realname])]
 
     async def register(self):
-        await self.write_line(IRCLine(verb="NICK", params=[self.nick]))
-        await self.write_line(IRCLine(verb="USER", params=[self.ident, '0', '*', self.realname]))
+        await self.write_lines(self.registration_lines())
 
     async def on_register(self):
         self.registered = True
+        self.timings['connect_to_001'] = time.monotonic() - self._connect_started
+        self._connection_timers.append(self.scheduler.call_every(PING_FREQ_SECS, self._send_ping, delay=0))
+        self._connection_timers.append(self.scheduler.call_every(SEEK_NICK_CHECK_FREQ, self._check_nick))
 
-    async def add_event(self, name: str, data: str):
+    async def on_disconnect(self):
+        for handle in self._connection_timers:
+            handle.cancel()
+        self._connection_timers.clear()
+        self._cancel_ping_timer()
+
+        self.registered = False
+        self.account = None
+        self.nick = self._seek_nick
+        self._ping_key = None
+        self._last_ping = None
+        self.pending_responses.clear()
+
+    async def add_event(self, name: str, data: str, timeout=None):
         evt = asyncio.Event()
-        if name in self.pending_responses:
-            if data in self.pending_responses[name]:
-                self.pending_responses[name][data].append(evt)
-            else:
-                self.pending_responses[name][data] = [evt]
-        else:
-            self.pending_responses[name] = {data: [evt]}
-        await evt.wait()
+        waiters = self.pending_responses.setdefault(name, {}).setdefault(data, [])
+        waiters.append(evt)
+        try:
+            await asyncio.wait_for(evt.wait(), timeout)
+        finally:
+            # event_complete or on_disconnect may already have dropped the list
+            pending = self.pending_responses.get(name)
+            if pending is not None and pending.get(data) is waiters:
+                waiters.remove(evt)
+                if not waiters:
+                    pending.pop(data)
+                    if not pending:
+                        self.pending_responses.pop(name)
 
     def event_complete(self, name: str, data: str):
         if name in self.pending_responses:
-            if data in self.pending_responses[name]:
-                for evt in self.pending_responses[name][data]:
-                    evt.set()
-                self.pending_responses[name][data].clear()
+            waiters = self.pending_responses[name].pop(data, [])
+            if not self.pending_responses[name]:
+                self.pending_responses.pop(name)
+            for evt in waiters:
+                evt.set()
 
     async def handle_verb_001(self, line):
         await self.on_register()
@@ -413,52 +532,82 @@ class IRCBot:
     async def handle_verb_pong(self, line):
         if self._ping_key is not None and line.params[len(line.params)-1] == self._ping_key:
             self._ping_key = None
-
-    async def tick_client(self):
-        if not self.registered: return
-
-        now = time.time()
-
-        if self._ping_key is None:
-            if self._last_ping is None or now - self._last_ping > PING_FREQ_SECS:
-                self._ping_key = ("00000000" + hex(random.randint(0, 0x7fffffff))[2:])[-8:]
-                self._last_ping = now
-                await self.write_line(IRCLine(verb='PING', params=[self._ping_key]))
-        else:
-            if self._last_ping is not None and now - self._last_ping > PING_TIMEOUT_SECS:
-                await self.quit(f"No ping reply in {int(now - self._last_ping)} seconds")
-                self.shutdown()
-
-        if self.nick != self._seek_nick and now - self._seek_nick_check > SEEK_NICK_CHECK_FREQ:
+            self._cancel_ping_timer()
+
+    def _cancel_ping_timer(self):
+        if self._ping_timer is not None:
+            self._ping_timer.cancel()
+            self._ping_timer = None
+
+    async def _send_ping(self):
+        if self._ping_key is not None:
+            return  # the timeout check for the outstanding ping will deal with it
+        self._ping_key = ("00000000" + hex(random.randint(0, 0x7fffffff))[2:])[-8:]
+        self._last_ping = time.time()
+        self._cancel_ping_timer()
+        self._ping_timer = self.scheduler.call_later(PING_TIMEOUT_SECS, self._check_ping_timeout, self._ping_key)
+        await self.write_line(IRCLine(verb='PING', params=[self._ping_key]))
+
+    # No QUIT: draining a dead connection could block forever
+    async def _check_ping_timeout(self, ping_key):
+        if self._ping_key is not None and self._ping_key == ping_key:
+            self._ping_timer = None
+            print(f"No ping reply in {int(time.time() - self._last_ping)} seconds, disconnecting")
+            self.disconnect(abort=True)
+
+    async def _check_nick(self):
+        if self.nick != self._seek_nick:
             await self.write_line(IRCLine(verb='ISON', params=[self._seek_nick]))
-            self._seek_nick_check = now
 
     async def connect(self, host, port, ssl=None):
+        self._connect_started = time.monotonic()
+        self.timings = {}
         reader, self._writer = await asyncio.open_connection(host=host, port=port, ssl=ssl)
+        self.scheduler.start()
 
         try:
             await self.on_connect()
 
             partial = ''
             while not reader.at_eof() and not self._shutdown:
-                await self.tick_client()
+                data = await reader.read(16384)
+                lines = data.decode("utf-8", errors="replace").split("\r\n")
+                lines[0] = partial + lines[0]
+                partial = lines.pop(-1)
+
+                for line in lines:
+                    if line == '' or line.isspace(): continue
+                    await self.handle_raw_line(line)
+        finally:
+            self._writer.close()
+            self._writer = None
+            await self.on_disconnect()
 
+    # Reconnects with jittered exponential backoff until shutdown()
+    async def run(self, host, port, ssl=None):
+        attempts = 0
+        self.scheduler.start()
+        try:
+            while not self._shutdown:
+                started = time.time()
                 try:
-                    data = await asyncio.wait_for(reader.read(16384), 5.0)
-                    lines = data.decode("utf-8", errors="replace").split("\r\n")
-                    lines[0] = partial + lines[0]
-                    partial = lines.pop(-1)
-
-                    for line in lines:
-                        if line == '' or line.isspace(): continue
-                        await self.handle_raw_line(line)
-                except asyncio.TimeoutError:
-                    pass
+                    await self.connect(host, port, ssl)
+                except (OSError, asyncio.TimeoutError) as ex:
+                    print(f"Connection to {host}:{port} failed: {type(ex).__name__}: {ex}")
+
+                if self._shutdown:
+                    break
+                if time.time() - started > RECONNECT_STABLE_SECS:
+                    attempts = 0
+                delay = random.uniform(RECONNECT_MIN_SECS, min(RECONNECT_MAX_SECS, RECONNECT_MIN_SECS * 2 ** attempts))
+                attempts += 1
+                print(f"Reconnecting in {delay:.1f} seconds (attempt {attempts})")
+                await asyncio.sleep(delay)
         finally:
-            self._writer.close()
+            self.scheduler.stop()
 
 
-# Doesn't send CAP END, and will not ever finish registering on CAP 302 servers
+# Registration: cap_ls -> cap_req -> [sasl ->] cap_end -> registered, each waiting stage with its own timeout
 class CapAwareIRCBot(IRCBot):
     def __init__(self, req_caps=None, **kwargs):
         super().__init__(**kwargs)
@@ -471,9 +620,40 @@ class CapAwareIRCBot(IRCBot):
         self.server_caps = {}
         self.our_caps = {}
 
+        self.reg_stage = None
+        self._stage_timer = None
+        self._ls_pending = {}
+
+    def enter_stage(self, stage, timeout=None, on_timeout=None):
+        self.reg_stage = stage
+        if self._stage_timer is not None:
+            self._stage_timer.cancel()
+            self._stage_timer = None
+        if timeout is not None:
+            self._stage_timer = self.scheduler.call_later(timeout, self._stage_timed_out, stage, on_timeout)
+            self._connection_timers.append(self._stage_timer)
+
+    async def _stage_timed_out(self, stage, on_timeout):
+        if self.reg_stage == stage:
+            print(f"Registration stage '{stage}' timed out")
+            await on_timeout()
+
     async def register(self):
-        await self.cap_ls(wait=False)
-        await super().register()
+        self.server_caps.clear()
+        self._ls_pending.clear()
+        self.enter_stage('cap_ls', CAP_TIMEOUT_SECS, self.cap_end)
+        await self.write_lines([IRCLine(verb='CAP', params=['LS', '302'])] + self.registration_lines())
+
+    async def on_register(self):
+        self.enter_stage('registered')
+        await super().on_register()
+
+    async def on_disconnect(self):
+        await super().on_disconnect()
+        self.enter_stage(None)
+        self.server_caps.clear()
+        self.our_caps.clear()
+        self._ls_pending.clear()
 
     async def handle_verb_cap(self, line):
         subcmd = line.params[1]
@@ -481,19 +661,28 @@ class CapAwareIRCBot(IRCBot):
             caplist = line.params[len(line.params)-1].split(' ')
             caps = {}
             for capspec in caplist:
+                if not capspec: continue
                 capsplt = capspec.split('=', maxsplit=1)
                 val = ''
                 if len(capsplt) == 2:
                     val = capsplt[1]
                 caps[capsplt[0]] = val
-            if subcmd == 'LS': await self.on_cap_ls(caps)
-            else: await self.on_cap_new(caps)
+            if subcmd == 'NEW':
+                await self.on_cap_new(caps)
+                return
 
-            if len(line.params) == 3:
-                self.event_complete('cap_ls', '*')
+            # Multi-line LS replies mark every line but the last with a '*' parameter
+            self._ls_pending.update(caps)
+            if len(line.params) > 3 and line.params[2] == '*':
+                return
+            caps = self._ls_pending
+            self._ls_pending = {}
+            await self.on_cap_ls(caps)
+            self.event_complete('cap_ls', '*')
         elif subcmd == 'ACK':
             caps = line.params[2].split(' ')
             for cap in caps:
+                if not cap: continue
                 if cap[0] == '-':
                     cap = cap[1:]
                     if cap in self.our_caps:
@@ -504,36 +693,55 @@ class CapAwareIRCBot(IRCBot):
         elif subcmd == 'NAK':
             caps = line.params[2].split(' ')
             for cap in caps:
+                if not cap: continue
                 await self.on_cap_nak(cap)
         elif subcmd == 'DEL':
             caps = line.params[2].split(' ')
             await self.on_cap_del(caps)
 
-    async def cap_ls(self, wait=True):
+    async def cap_ls(self, wait=True, timeout=CAP_TIMEOUT_SECS):
         self.server_caps.clear()
         await self.write_line(IRCLine(verb='CAP', params=['LS', '302']))
         if wait:
-            await self.add_event('cap_ls', '*')
+            await self.add_event('cap_ls', '*', timeout)
 
-    async def cap_req(self, caps: [str], wait=True):
-        # FIXME: prevent from going over length and from requesting empty list
-        await self.write_line(IRCLine(verb='CAP', params=['REQ', ' '.join(caps)]))
+    def cap_req_line(self, caps: [str]):
+        # FIXME: prevent from going over length
+        return IRCLine(verb='CAP', params=['REQ', ' '.join(caps)])
+
+    async def cap_req(self, caps: [str], wait=True, timeout=CAP_TIMEOUT_SECS):
+        if not caps: return
+        await self.write_line(self.cap_req_line(caps))
         if wait:
             coros = []
             for cap in caps:
-                coros.append(self.add_event('cap_req', cap))
+                coros.append(self.add_event('cap_req', cap, timeout))
             await asyncio.gather(*coros)
 
     async def cap_end(self, wait=True):
+        if self.registered or self.reg_stage == 'cap_end':
+            return
+        self.enter_stage('cap_end')
         await self.write_line(IRCLine(verb='CAP', params=['END']))
 
+    async def negotiate_caps(self, to_req: [str]):
+        if not to_req:
+            await self.cap_end()
+            return
+        self.enter_stage('cap_end')
+        await self.write_lines([self.cap_req_line(to_req), IRCLine(verb='CAP', params=['END'])])
+
     async def on_cap_ls(self, caps: {}):
         to_req = []
         for cap in caps:
             self.server_caps[cap] = caps[cap]
             if cap in self.req_caps and cap not in self.our_caps:
                 to_req.append(cap)
-        if len(to_req) > 0:
+
+        if self.reg_stage == 'cap_ls':
+            self.enter_stage('cap_req', CAP_TIMEOUT_SECS, self.cap_end)
+            await self.negotiate_caps(to_req)
+        elif len(to_req) > 0:
             await self.cap_req(to_req, wait=False)
 
     async def on_cap_ack(self, name: str):
@@ -561,14 +769,29 @@ class SASLIRCBot(CapAwareIRCBot):
         self.sasl_auth = (sasl_uname, sasl_pass)
         self.require_auth = require_auth
 
-    async def on_cap_ack(self, name: str):
-        await super(SASLIRCBot, self).on_cap_ack(name)
-        if name == 'sasl':
-            mechs = self.server_caps['sasl'].split(',')
-            if 'PLAIN' not in mechs and self.require_auth:
+    def sasl_plain_supported(self):
+        if 'sasl' not in self.server_caps:
+            return False
+        mechs = self.server_caps['sasl']
+        return mechs == '' or 'PLAIN' in mechs.split(',')
+
+    # AUTHENTICATE is pipelined behind CAP REQ, which the server handles first
+    async def negotiate_caps(self, to_req: [str]):
+        if 'sasl' not in to_req or not self.sasl_plain_supported():
+            if self.require_auth:
                 await self.quit("SASL PLAIN not supported")
                 return
-            await self.write_line(IRCLine(verb='AUTHENTICATE', params=['PLAIN']))
+            await super().negotiate_caps([cap for cap in to_req if cap != 'sasl'])
+            return
+
+        self.enter_stage('sasl', SASL_TIMEOUT_SECS, self.sasl_error)
+        await self.write_lines([self.cap_req_line(to_req), IRCLine(verb='AUTHENTICATE', params=['PLAIN'])])
+        self.timings['sasl_started'] = time.monotonic() - self._connect_started
+
+    async def on_cap_ack(self, name: str):
+        await super(SASLIRCBot, self).on_cap_ack(name)
+        if name == 'sasl' and self.registered and self.account is None and self.sasl_plain_supported():
+            await self.write_line(IRCLine(verb='AUTHENTICATE', params=['PLAIN']))  # requested after registering
 
     async def handle_verb_authenticate(self, line):
         if line.params[0] == '+':
@@ -591,6 +814,7 @@ class SASLIRCBot(CapAwareIRCBot):
         await self.sasl_error()
 
     async def handle_verb_903(self, line):
+        self.timings['sasl_done'] = time.monotonic() - self._connect_started
         await self.cap_end()
 
     async def handle_verb_904(self, line):
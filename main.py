@@ -8,7 +8,10 @@ config: {}
 
 async def amain():
     the_bot = bot.FABot(config['bot'], bot_secrets)
-    await the_bot.connect(config['uplink']['host'], config['uplink']['port'], config['uplink']['ssl'])
+    try:
+        await the_bot.run(config['uplink']['host'], config['uplink']['port'], config['uplink']['ssl'])
+    finally:
+        the_bot.close()
 
 
 def main():
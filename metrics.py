@@ -0,0 +1,239 @@
+import asyncio
+import bisect
+import contextlib
+import threading
+import time
+
+SCRAPE_TIMEOUT_SECS = 5
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Metrics record nothing until enable() is called, except the few declared always_on because the stats command reads them
+enabled = False
+_lock = threading.Lock()  # e621 and FA lookups report from executor threads
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+class Counter:
+    __slots__ = ('name', 'doc', 'labelnames', 'values', 'always_on')
+    kind = 'counter'
+
+    def __init__(self, name, doc, labelnames=(), always_on=False):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self.values = {}
+        self.always_on = always_on
+
+    def inc(self, *labels, amount=1):
+        if not (enabled or self.always_on):
+            return
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def total(self):
+        return sum(self.values.values())
+
+    def collect(self):
+        with _lock:
+            return dict(self.values)
+
+
+# Gauges can also be read from a function at collection time
+class Gauge:
+    __slots__ = ('name', 'doc', 'labelnames', 'values', '_fn')
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self.values = {}
+        self._fn = None
+
+    def set(self, value, *labels):
+        if not enabled:
+            return
+        self.values[labels] = value
+
+    # fn returns a single value, or a dict of label tuples to values for a labelled gauge
+    def set_function(self, fn):
+        self._fn = fn
+
+    def collect(self):
+        if self._fn is None:
+            return dict(self.values)
+        res = self._fn()
+        return res if type(res) is dict else {(): res}
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+_NULL_TIMER = contextlib.nullcontext()
+
+
+class Histogram:
+    __slots__ = ('name', 'doc', 'labelnames', 'buckets', 'values', 'always_on')
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=LATENCY_BUCKETS, always_on=False):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [per-bucket counts (last one is +Inf), sum, count]
+        self.always_on = always_on
+
+    def observe(self, value, *labels):
+        if not (enabled or self.always_on):
+            return
+        idx = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = [[0] * (len(self.buckets) + 1), 0, 0]
+                self.values[labels] = entry
+            entry[0][idx] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels) if enabled or self.always_on else _NULL_TIMER
+
+    def count(self):
+        return sum(entry[2] for entry in self.values.values())
+
+    # Per-bucket counts summed across all label sets
+    def bucket_counts(self):
+        counts = [0] * (len(self.buckets) + 1)
+        with _lock:
+            for entry in self.values.values():
+                for idx, n in enumerate(entry[0]):
+                    counts[idx] += n
+        return counts
+
+    # Interpolated within buckets; with since, only observations after that bucket_counts() count
+    def quantile(self, q, since=None):
+        counts = self.bucket_counts()
+        if since is not None:
+            counts = [n - before for n, before in zip(counts, since)]
+        total = sum(counts)
+        if total == 0:
+            return None
+
+        rank = q * total
+        seen = 0
+        for idx, n in enumerate(counts):
+            if seen + n >= rank and n > 0:
+                if idx == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[idx - 1] if idx > 0 else 0
+                return lower + (self.buckets[idx] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def collect(self):
+        with _lock:
+            return {labels: ([*entry[0]], entry[1], entry[2]) for labels, entry in self.values.items()}
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, cls, name, doc, labelnames, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = cls(name, doc, tuple(labelnames), **kwargs)
+            self.metrics[name] = metric
+        return metric
+
+    def counter(self, name, doc, labelnames=(), always_on=False):
+        return self._register(Counter, name, doc, labelnames, always_on=always_on)
+
+    def gauge(self, name, doc, labelnames=()):
+        return self._register(Gauge, name, doc, labelnames)
+
+    def histogram(self, name, doc, labelnames=(), buckets=LATENCY_BUCKETS, always_on=False):
+        return self._register(Histogram, name, doc, labelnames, buckets=buckets, always_on=always_on)
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def render_prometheus(registry=REGISTRY):
+    out = []
+    for metric in registry.metrics.values():
+        out.append(f"# HELP {metric.name} {metric.doc}")
+        out.append(f"# TYPE {metric.name} {metric.kind}")
+        if metric.kind != 'histogram':
+            for labels, value in metric.collect().items():
+                out.append(f"{metric.name}{_format_labels(metric.labelnames, labels)} {value}")
+            continue
+
+        for labels, (counts, total, count) in metric.collect().items():
+            cumulative = 0
+            for bound, n in zip(metric.buckets + ('+Inf',), counts):
+                cumulative += n
+                out.append(f"{metric.name}_bucket{_format_labels(metric.labelnames, labels, ('le', bound))} {cumulative}")
+            out.append(f"{metric.name}_sum{_format_labels(metric.labelnames, labels)} {total}")
+            out.append(f"{metric.name}_count{_format_labels(metric.labelnames, labels)} {count}")
+    return '\n'.join(out) + '\n'
+
+
+# Minimal HTTP/1.0 endpoint for Prometheus scrapes; anything but GET /metrics gets a 404
+async def _handle_scrape(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), SCRAPE_TIMEOUT_SECS)
+        while (await asyncio.wait_for(reader.readline(), SCRAPE_TIMEOUT_SECS)) not in (b'\r\n', b'\n', b''):
+            pass
+
+        parts = request.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = "200 OK", render_prometheus().encode('utf-8')
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(host='127.0.0.1', port=9464):
+    return await asyncio.start_server(_handle_scrape, host, port)
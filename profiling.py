@@ -0,0 +1,52 @@
+import cProfile
+import os
+import pstats
+import time
+
+PROFILE_DEFAULT_SECS = 30
+PROFILE_MAX_SECS = 10 * 60
+PROFILE_DIR = 'profiles'
+PROFILE_TOP_N = 5
+
+
+# Only the event loop thread is profiled
+class ProfileSession:
+    def __init__(self, directory=PROFILE_DIR):
+        self.directory = directory
+        self._profile = None
+        self.started = None
+        self.owner = None
+        self.timer = None
+
+    @property
+    def active(self):
+        return self._profile is not None
+
+    def start(self, owner):
+        profile = cProfile.Profile()
+        profile.enable()  # raises ValueError if another profiler is already hooked in
+        self._profile = profile
+        self.started = time.time()
+        self.owner = owner
+
+    def stop(self):
+        profile = self._profile
+        profile.disable()
+        self._profile = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        return profile
+
+    def get_filename(self):
+        return os.path.join(self.directory, time.strftime('profile-%Y%m%d-%H%M%S.prof', time.localtime(self.started)))
+
+
+def write_profile(profile, filename, top_n=PROFILE_TOP_N):
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    profile.dump_stats(filename)
+
+    stats = pstats.Stats(profile).stats
+    top = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:top_n]
+    return [f"{func} ({os.path.basename(file)}:{line}): {tt:.3f}s self, {ct:.3f}s total, {nc} calls"
+            for (file, line, func), (cc, nc, tt, ct, callers) in top]
@@ -0,0 +1,148 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import time
+
+import metrics
+
+QUOTA_IDLE_SECS = 60 * 60
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITY_NAMES = ('high', 'normal', 'low')
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN_SECS = 300
+
+LIMITER_WAIT_SECONDS = metrics.histogram('ratelimit_wait_seconds', "Time spent waiting for an upstream call slot", ('limiter', 'priority'))
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def available(self, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens
+
+    def try_take(self, cost=1, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+# Buckets idle long enough to be full again are dropped from the front
+class QuotaTable:
+    def __init__(self, rate, capacity, idle_secs=QUOTA_IDLE_SECS):
+        self.rate = rate
+        self.capacity = capacity
+        self.idle_secs = idle_secs
+        self._buckets = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _get(self, key, now):
+        while self._buckets:
+            oldest = next(iter(self._buckets.values()))
+            if now - oldest.updated < self.idle_secs:
+                break
+            self._buckets.popitem(last=False)
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.capacity, now)
+            self._buckets[key] = bucket
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def available(self, key):
+        now = time.monotonic()
+        return self._get(key, now).available(now)
+
+    def try_take(self, key, cost=1):
+        now = time.monotonic()
+        return self._get(key, now).try_take(cost, now)
+
+
+# One call slot per interval, handed out by priority and then arrival
+class IntervalLimiter:
+    def __init__(self, interval, name='default'):
+        self.name = name
+        self.interval = interval
+        self._last = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._dispatcher = None
+
+    def __len__(self):
+        return len(self._waiters)
+
+    async def wait(self, priority=PRIORITY_NORMAL):
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        with LIMITER_WAIT_SECONDS.time(self.name, PRIORITY_NAMES[priority]):
+            await fut
+
+    async def _dispatch(self):
+        while self._waiters:
+            delay = self._last + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            while self._waiters:
+                fut = heapq.heappop(self._waiters)[2]
+                if not fut.done():
+                    self._last = time.monotonic()
+                    fut.set_result(None)
+                    break
+
+
+# After enough consecutive failures, lets one trial call through per cooldown
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN_SECS):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    def allow(self, now=None):
+        if self.opened is None:
+            return True
+        if now is None:
+            now = time.monotonic()
+        if now - self.opened < self.cooldown:
+            return False
+        self.opened = now
+        return True
+
+    # Returns True if this failure tripped the breaker
+    def record_failure(self, now=None):
+        self.failures += 1
+        if self.failures < self.threshold:
+            return False
+        tripped = self.opened is None
+        self.opened = time.monotonic() if now is None else now
+        return tripped
+
+    def record_success(self):
+        self.failures = 0
+        self.opened = None
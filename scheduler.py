@@ -0,0 +1,93 @@
+import asyncio
+import heapq
+import itertools
+import time
+import traceback
+
+import metrics
+
+EVENT_LOOP_LAG_SECONDS = metrics.histogram('event_loop_lag_seconds', "How late timers fire relative to their due time")
+
+
+class TimerHandle:
+    __slots__ = ('when', 'interval', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, interval, callback, args):
+        self.when = when
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+# Coroutine callbacks run as their own tasks so a slow job doesn't delay later timers
+class Scheduler:
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _push(self, handle):
+        heapq.heappush(self._heap, (handle.when, next(self._seq), handle))
+        if self._heap[0][2] is handle:
+            self._wakeup.set()
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self._push(TimerHandle(time.monotonic() + delay, None, callback, args))
+
+    def call_every(self, interval, callback, *args, delay=None):
+        if delay is None:
+            delay = interval
+        return self._push(TimerHandle(time.monotonic() + delay, interval, callback, args))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _fire(self, handle):
+        try:
+            res = handle.callback(*handle.args)
+            if asyncio.iscoroutine(res):
+                asyncio.ensure_future(self._await_job(res))
+        except Exception as ex:
+            traceback.print_exception(type(ex), ex, ex.__traceback__)
+
+    @staticmethod
+    async def _await_job(coro):
+        try:
+            await coro
+        except Exception as ex:
+            traceback.print_exception(type(ex), ex, ex.__traceback__)
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                handle = heapq.heappop(self._heap)[2]
+                if handle.cancelled:
+                    continue
+                EVENT_LOOP_LAG_SECONDS.observe(now - handle.when)
+                if handle.interval is not None:
+                    handle.when = max(handle.when + handle.interval, now)
+                    heapq.heappush(self._heap, (handle.when, next(self._seq), handle))
+                self._fire(handle)
+
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,76 @@
+import e6handler
+
+
+class ChannelPolicy:
+    __slots__ = ('name', 'key', 'prefixes', 'allow_nsfw', 'blacklist')
+
+    def __init__(self, name, chandata):
+        self.name = name
+        self.key = chandata.get('key')
+        self.prefixes = frozenset(chandata.get('prefix', ''))
+        self.allow_nsfw = chandata.get('nsfw') == 'true'
+        self.blacklist = e6handler.BLACKLIST_POST | frozenset(chandata.get('blacklist', '').lower().split())
+
+
+class BotState:
+    def __init__(self, store):
+        self.store = store
+        self.channels = {name: ChannelPolicy(name, chandata) for name, chandata in store.data['channels'].items()}
+        self.admins = set(store.data['admins'])
+        self.optout = set(store.data['optout'])
+
+    def is_admin(self, account):
+        return account is not None and account.lower() in self.admins
+
+    def is_opted_out(self, account):
+        return account is not None and account.lower() in self.optout
+
+    def add_channel(self, name, key=None):
+        chandata = {}
+        if key is not None:
+            chandata['key'] = key
+        self.store.set(['channels', name], chandata)
+        self.channels[name] = ChannelPolicy(name, chandata)
+
+    def remove_channel(self, name):
+        self.store.delete(['channels', name])
+        self.channels.pop(name, None)
+
+    def get_channel_option(self, name, key):
+        return self.store.data['channels'][name].get(key)
+
+    def set_channel_option(self, name, key, value):
+        if value is None:
+            if key in self.store.data['channels'][name]:
+                self.store.delete(['channels', name, key])
+        else:
+            self.store.set(['channels', name, key], value)
+        self.channels[name] = ChannelPolicy(name, self.store.data['channels'][name])
+
+    def add_admin(self, account):
+        if account in self.admins:
+            return False
+        self.store.add(['admins'], account)
+        self.admins.add(account)
+        return True
+
+    def remove_admin(self, account):
+        if account not in self.admins:
+            return False
+        self.store.remove(['admins'], account)
+        self.admins.discard(account)
+        return True
+
+    def add_optout(self, account):
+        if account in self.optout:
+            return False
+        self.store.add(['optout'], account)
+        self.optout.add(account)
+        return True
+
+    def remove_optout(self, account):
+        if account not in self.optout:
+            return False
+        self.store.remove(['optout'], account)
+        self.optout.discard(account)
+        return True
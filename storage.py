@@ -0,0 +1,140 @@
+import concurrent.futures
+import copy
+import json
+import os
+import traceback
+
+COMPACT_AFTER_CHANGES = 500
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return  # not supported on this platform
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# JSON snapshot plus an append-only change log, written by a background thread
+class JournaledStore:
+    def __init__(self, filename, default):
+        self.filename = filename
+        self.log_filename = filename + '.log'
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
+        self._log_fp = None
+        self._changes = 0
+
+        try:
+            with open(filename, 'r') as fp:
+                self.data = json.load(fp)
+        except IOError:
+            self.data = copy.deepcopy(default)
+
+        # Rewritten so a torn log line is never appended to
+        self._replay_log()
+        self.compact()
+
+    def _replay_log(self):
+        try:
+            with open(self.log_filename, 'r') as fp:
+                for line in fp:
+                    try:
+                        change = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # torn write from a crash, nothing after it was acknowledged
+                    self._apply(change)
+                    self._changes += 1
+        except IOError:
+            pass
+
+    # A stale log replayed over a newer snapshot can name paths deleted later in it; those changes are skipped
+    def _apply(self, change):
+        *parents, key = change['path']
+        container = self.data
+        for part in parents:
+            container = container.get(part)
+            if container is None:
+                return
+
+        op = change['op']
+        if op == 'set':
+            container[key] = change['value']
+        elif op == 'del':
+            container.pop(key, None)
+        elif key not in container:
+            return
+        elif op == 'add':
+            if change['value'] not in container[key]:
+                container[key].append(change['value'])
+        elif op == 'remove':
+            if change['value'] in container[key]:
+                container[key].remove(change['value'])
+
+    def _record(self, change):
+        self._apply(change)
+        self._submit(self._write_change, json.dumps(change))
+        self._changes += 1
+        if self._changes >= COMPACT_AFTER_CHANGES:
+            self.compact()
+
+    def _submit(self, fn, *args):
+        def run():
+            try:
+                fn(*args)
+            except BaseException as ex:
+                traceback.print_exception(type(ex), ex, ex.__traceback__)
+        return self._executor.submit(run)
+
+    def _write_change(self, encoded):
+        if self._log_fp is None:
+            self._log_fp = open(self.log_filename, 'a')
+        self._log_fp.write(encoded + '\n')
+        self._log_fp.flush()
+        os.fsync(self._log_fp.fileno())
+
+    def _write_snapshot(self, data):
+        encoded = json.dumps(data)
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as fp:
+            fp.write(encoded)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_filename, self.filename)
+        _fsync_dir(self.filename)
+
+        if self._log_fp is not None:
+            self._log_fp.close()
+            self._log_fp = None
+        with open(self.log_filename, 'w') as fp:
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def set(self, path, value):
+        self._record({'op': 'set', 'path': path, 'value': value})
+
+    def delete(self, path):
+        self._record({'op': 'del', 'path': path})
+
+    def add(self, path, value):
+        self._record({'op': 'add', 'path': path, 'value': value})
+
+    def remove(self, path, value):
+        self._record({'op': 'remove', 'path': path, 'value': value})
+
+    def compact(self):
+        self._changes = 0
+        # Copied, since the loop keeps changing self.data
+        return self._submit(self._write_snapshot, copy.deepcopy(self.data))
+
+    def flush(self):
+        if self._changes > 0:
+            self.compact()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._log_fp is not None:
+            self._log_fp.close()
+            self._log_fp = None
@@ -0,0 +1,143 @@
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import itertools
+import json
+import os
+import time
+import traceback
+
+SLOW_TRACE_SECS = 2.0
+
+# Tracing is off (and every hook a no-op) until configure() is given a file to dump slow traces to
+dump_file = None
+slow_secs = SLOW_TRACE_SECS
+
+_trace_var = contextvars.ContextVar('trace', default=None)
+_span_var = contextvars.ContextVar('span', default=None)
+_trace_ids = itertools.count(1)
+_dump_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='tracing')
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+def configure(filename, threshold=SLOW_TRACE_SECS):
+    global dump_file, slow_secs
+    dump_file = filename
+    slow_secs = threshold
+
+
+# Held open by queued jobs and executor calls; finished, and dumped if slow, once the last is done
+class Trace:
+    __slots__ = ('trace_id', 'name', 'wall_start', 'start', 'spans', 'pending', '_span_ids')
+
+    def __init__(self, name):
+        self.trace_id = f"{os.getpid():x}-{next(_trace_ids):x}"
+        self.name = name
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.spans = []
+        self.pending = 0
+        self._span_ids = itertools.count(1)
+
+    def retain(self):
+        self.pending += 1
+
+    def release(self):
+        self.pending -= 1
+        if self.pending == 0:
+            self.finish()
+
+    def add_span(self, name, start, end, parent, attrs, span_id=None):
+        span = {'id': span_id or next(self._span_ids), 'parent': parent, 'name': name,
+                'start_ms': round((start - self.start) * 1000, 3), 'duration_ms': round((end - start) * 1000, 3)}
+        if attrs:
+            span['attrs'] = attrs
+        self.spans.append(span)  # may be called from executor threads
+
+    def finish(self):
+        duration = time.perf_counter() - self.start
+        if dump_file is None or duration < slow_secs:
+            return
+        record = {'trace_id': self.trace_id, 'name': self.name, 'start': self.wall_start,
+                  'duration_ms': round(duration * 1000, 3), 'spans': sorted(self.spans, key=lambda span: span['start_ms'])}
+        _dump_executor.submit(_write_record, dump_file, record)  # finish usually runs on the loop, so keep disk I/O off it
+
+
+def _write_record(filename, record):
+    try:
+        with open(filename, 'a') as fp:
+            fp.write(json.dumps(record) + '\n')
+    except Exception as ex:
+        traceback.print_exception(type(ex), ex, ex.__traceback__)
+
+
+class _TraceContext:
+    __slots__ = ('trace', 'token')
+
+    def __init__(self, name):
+        self.trace = Trace(name)
+
+    def __enter__(self):
+        self.trace.retain()
+        self.token = _trace_var.set(self.trace)
+        return self.trace
+
+    def __exit__(self, exc_type, exc, tb):
+        _trace_var.reset(self.token)
+        self.trace.release()
+
+
+class _SpanContext:
+    __slots__ = ('trace', 'name', 'attrs', 'span_id', 'parent', 'token', 'start')
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.span_id = next(self.trace._span_ids)
+        self.parent = _span_var.get()
+        self.token = _span_var.set(self.span_id)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        _span_var.reset(self.token)
+        self.trace.add_span(self.name, self.start, end, self.parent, self.attrs, self.span_id)
+
+
+def start_trace(name):
+    if dump_file is None:
+        return _NULL_CONTEXT
+    return _TraceContext(name)
+
+
+def span(name, **attrs):
+    trace = _trace_var.get()
+    if trace is None:
+        return _NULL_CONTEXT
+    return _SpanContext(trace, name, attrs)
+
+
+def traced(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_trace():
+    return _trace_var.get()
+
+
+# For intervals that can't be wrapped in a with block, such as time spent sitting in a queue
+def record_span(name, start, end=None, **attrs):
+    trace = _trace_var.get()
+    if trace is not None:
+        trace.add_span(name, start, time.perf_counter() if end is None else end, _span_var.get(), attrs)
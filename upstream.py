@@ -0,0 +1,13 @@
+import metrics
+
+UPSTREAM_SECONDS = metrics.histogram('upstream_request_seconds', "Latency of requests to upstream sites", ('service',))
+UPSTREAM_RESPONSES = metrics.counter('upstream_responses_total', "Responses from upstream sites by status code", ('service', 'status'))
+
+
+# 'notfound' and 'transient' errors are cached, 'auth' trips the breaker, 'error' is anything else
+def get_error_kind(status_code):
+    if status_code in (401, 403):
+        return 'auth'
+    elif status_code == 429 or status_code >= 500:
+        return 'transient'
+    return 'error'
@@ -0,0 +1,100 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+WATCHDOG_INTERVAL_SECS = 0.1
+STALL_THRESHOLD_SECS = 0.5
+STACK_SUMMARY_FRAMES = 4
+_HANDLE_RUN_CODE = asyncio.events.Handle._run.__code__
+
+LOOP_STALLS = metrics.counter('event_loop_stalls_total', "Times the event loop was blocked past the stall threshold", ('task',))
+LOOP_STALL_SECONDS = metrics.histogram('event_loop_stall_seconds', "How long the event loop was blocked for each stall")
+
+
+class StallReport:
+    __slots__ = ('task', 'stack', 'duration')
+
+    def __init__(self, task, stack):
+        self.task = task
+        self.stack = stack
+        self.duration = None
+
+    # Innermost frames only, as "file:line function" - short enough for a log channel message
+    def summary(self, frames=STACK_SUMMARY_FRAMES):
+        return ' < '.join(f"{entry.filename.rsplit('/', 1)[-1]}:{entry.lineno} {entry.name}" for entry in reversed(self.stack[-frames:]))
+
+
+# Samples the loop thread's stack once the heartbeat is late by more than the threshold
+class LoopWatchdog:
+    def __init__(self, on_stall=None, threshold=STALL_THRESHOLD_SECS, interval=WATCHDOG_INTERVAL_SECS):
+        self.on_stall = on_stall
+        self.threshold = threshold
+        self.interval = interval
+        self._loop = None
+        self._loop_thread = None
+        self._beat_handle = None
+        self._last_beat = None
+        self._pending = None
+        self._pending_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, loop):
+        if self._thread is not None:
+            return
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._beat_handle = loop.call_later(self.interval, self._beat)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._monitor, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._beat_handle.cancel()
+        self._thread.join()
+        self._thread = None
+
+    def _beat(self):
+        now = time.monotonic()
+        with self._pending_lock:
+            report, self._pending = self._pending, None
+        duration = now - self._last_beat - self.interval
+        if report is not None and duration >= self.threshold:  # the monitor can race with a beat
+            report.duration = duration
+            LOOP_STALLS.inc(report.task)
+            LOOP_STALL_SECONDS.observe(report.duration)
+            if self.on_stall is not None:
+                self.on_stall(report)
+        self._last_beat = now
+        self._beat_handle = self._loop.call_later(self.interval, self._beat)
+
+    # current_task() isn't safe off the loop thread, so the task comes from the Handle being run in the sampled stack
+    @staticmethod
+    def _task_name(frame):
+        while frame is not None:
+            if frame.f_code is _HANDLE_RUN_CODE:
+                handle = frame.f_locals.get('self')
+                task = getattr(getattr(handle, '_callback', None), '__self__', None)
+                return task.get_name() if isinstance(task, asyncio.Task) else 'loop callback'
+            frame = frame.f_back
+        return 'unknown'
+
+    def _monitor(self):
+        while not self._stop.wait(self.interval):
+            if time.monotonic() - self._last_beat - self.interval < self.threshold:
+                continue
+
+            with self._pending_lock:
+                if self._pending is not None:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread)
+                stack = traceback.extract_stack(frame) if frame is not None else []
+                self._pending = StallReport(self._task_name(frame), stack)
@@ -0,0 +1,94 @@
+import asyncio
+import collections
+import contextvars
+import time
+import traceback
+
+import tracing
+
+
+# Per-channel queues served round-robin, so a flood in one channel delays others by one job per turn
+class FairWorkQueue:
+    def __init__(self, per_channel_limit=2, global_limit=4):
+        self.per_channel_limit = per_channel_limit
+        self.global_limit = global_limit
+        self._queues = collections.OrderedDict()
+        self._running = collections.Counter()
+        self.queued = 0
+        self.running = 0
+
+    @property
+    def backlog(self):
+        return self.queued + self.running
+
+    def queue_depth(self, chan):
+        queue = self._queues.get(chan)
+        return (len(queue) if queue is not None else 0) + self._running[chan]
+
+    # Jobs run in their submitter's context and hold its trace open
+    def submit(self, chan, fn, *args):
+        trace = tracing.current_trace()
+        if trace is not None:
+            trace.retain()
+        job = (fn, args, contextvars.copy_context(), trace, time.perf_counter())
+        self._queues.setdefault(chan, collections.deque()).append(job)
+        self.queued += 1
+        self._pump()
+
+    def _next_job(self):
+        for chan, queue in self._queues.items():
+            if self._running[chan] >= self.per_channel_limit:
+                continue
+            job = queue.popleft()
+            if queue:
+                self._queues.move_to_end(chan)
+            else:
+                del self._queues[chan]
+            return chan, job
+        return None
+
+    def _pump(self):
+        while self.running < self.global_limit:
+            nxt = self._next_job()
+            if nxt is None:
+                return
+            chan, (fn, args, context, trace, submitted) = nxt
+            self.queued -= 1
+            self.running += 1
+            self._running[chan] += 1
+            task = context.run(self._start_job, chan, fn, args, submitted)
+            task.add_done_callback(lambda t, c=chan, tr=trace: self._job_done(c, t, tr))
+
+    @staticmethod
+    def _start_job(chan, fn, args, submitted):
+        tracing.record_span('queue_wait', submitted, channel=chan)
+        return asyncio.ensure_future(fn(*args))
+
+    def _job_done(self, chan, task, trace):
+        self.running -= 1
+        self._running[chan] -= 1
+        if self._running[chan] <= 0:
+            del self._running[chan]
+        if not task.cancelled() and task.exception() is not None:
+            ex = task.exception()
+            traceback.print_exception(type(ex), ex, ex.__traceback__)
+        if trace is not None:
+            trace.release()
+        self._pump()
+
+    @staticmethod
+    def _drop_jobs(jobs):
+        for job in jobs:
+            if job[3] is not None:
+                job[3].release()
+
+    def clear(self, chan=None):
+        if chan is None:
+            self.queued = 0
+            for queue in self._queues.values():
+                self._drop_jobs(queue)
+            self._queues.clear()
+        else:
+            queue = self._queues.pop(chan, ())
+            self.queued -= len(queue)
+            self._drop_jobs(queue)